@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Parse-time per page: the old r.json()-per-access pattern vs. decoding once. The old pattern is
+# simulated, not the old code: the page is decoded with r.json() of a requests.Response as often as
+# the original search loop and parse_tweets did for it, and parsed once by the current parse_tweets.
+#
+#   python bench/bench_parse.py [recorded_pages_dir]
+
+import sys
+import os
+import json
+import time
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import twitter_functions as tw
+from payloads import load_pages
+
+def legacy_decodes(page):
+    # r.json() calls the original code made for a page: 3 in the search_tweets loop (while,
+    # next_token, result_count), and in parse_tweets 1 for "includes", 2 for every kind of include
+    # that is there, 1 for those that aren't and 1 for "data"
+    n_decodes = 3 + 1 + 1
+    if "includes" in page:
+        n_decodes += sum(2 if kind in page["includes"] else 1 for kind in ["users", "tweets", "places", "media"])
+    return(n_decodes)
+
+def parse_legacy(content, cache):
+    r = requests.Response()
+    r._content = content
+    r.status_code = 200
+    for _ in range(legacy_decodes(json.loads(content)) - 1):
+        r.json()
+    return(tw.parse_tweets(r.json(), cache))
+
+def parse_stdlib(content, cache):
+    return(tw.parse_tweets(json.loads(content), cache))
+
+def parse_fast(content, cache):
+    return(tw.parse_tweets(tw.json_loads(content), cache))
+
+def run(parse, pages, repeat=3):
+    best = None
+    for _ in range(repeat):
+        cache = tw.EntityCache()
+        start = time.perf_counter()
+        for content in pages:
+            parse(content, cache)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return(best / len(pages))
+
+if __name__ == "__main__":
+    pages = load_pages(sys.argv[1] if len(sys.argv) > 1 else None)
+    if not pages:
+        print("No pages to benchmark")
+        sys.exit(1)
+
+    size = sum(len(p) for p in pages) / len(pages)
+    print(f"{len(pages)} pages, {size/1024:.0f} KiB per page, json backend: {tw.json_loads.__module__}")
+
+    n_decodes = sum(legacy_decodes(json.loads(p)) for p in pages) / len(pages)
+    legacy = run(parse_legacy, pages)
+    print(f"legacy (simulated, {n_decodes:.1f} r.json() per page): {legacy*1000:8.2f} ms/page")
+    stdlib = run(parse_stdlib, pages)
+    print(f"decode once (json):                          {stdlib*1000:8.2f} ms/page ({legacy/stdlib:.1f}x)")
+    fast = run(parse_fast, pages)
+    print(f"decode once (json_loads):                    {fast*1000:8.2f} ms/page ({legacy/fast:.1f}x)")
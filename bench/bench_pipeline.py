@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Fetch -> parse -> write throughput against the local mock server (mock_server.py), no network needed.
+# Every scenario runs in a fresh process, so peak RSS is its own.
+#
+#   python bench/bench_pipeline.py [recorded_pages_dir]
+
+import sys
+import os
+import json
+import time
+import shutil
+import tempfile
+import resource
+import datetime
+import logging
+import multiprocessing
+import queue
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import twitter_functions as tw
+import mock_server
+from payloads import load_pages
+from urllib3.util.retry import Retry
+from requests.adapters import HTTPAdapter
+
+def setup(api_url):
+    tw.api_url = api_url
+    # the injected 429s would log a warning each
+    logging.getLogger("twitter_functions").setLevel(logging.ERROR)
+    # same retries as the https:// adapter, without its multi-second backoff
+    tw.request_session.mount("http://", HTTPAdapter(max_retries=Retry(total=10, backoff_factor=0.01, status_forcelist=[500, 502, 503, 504]), pool_maxsize=16))
+    # the mock server's headers allow everything, only the full archive's 1 request/s would hold back
+    tw.rate_limits.defaults["tweets/search/all"] = (300, 900, 0)
+
+def search_csv(path):
+    return(tw.tweets_to_csv(tw.iter_search_tweets("from:user", "token", start_time="2021-01-01T00:00:00Z", mode="all"), f"{path}/search.csv"))
+
+def search_csv_processes(path):
+    return(tw.search_to_csv("from:user", "token", f"{path}/search.csv", start_time="2021-01-01T00:00:00Z", mode="all", processes=4))
+
+def backfill(path):
+    windows = [(datetime.datetime(2021, 1, 1) + datetime.timedelta(days=30*i), datetime.datetime(2021, 1, 1) + datetime.timedelta(days=30*(i + 1))) for i in range(8)]
+    return(sum(n_tweets for _, n_tweets in tw.backfill_windows("from:user", "token", windows, f"{path}/backfill.csv", max_workers=4)))
+
+def lookup(path):
+    tweets = tw.lookup_tweets_bulk((str(1400000000000000000 + i) for i in range(20000)), "token", max_workers=4)
+    return(tw.tweets_to_csv(tweets, f"{path}/lookup.csv"))
+
+def media(path):
+    tweets = tw.search_tweets("from:user", "token", start_time="2021-01-01T00:00:00Z", mode="all")
+    tw.media_download(tweets, base_path=f"{path}/media", max_workers=8)
+    return(len(tweets))
+
+scenarios = {
+    "search -> csv": search_csv,
+    "search -> csv (4 processes)": search_csv_processes,
+    "backfill 8 windows": backfill,
+    "lookup 20000 ids -> csv": lookup,
+    "search + media download": media
+}
+
+def server_stats(api_url):
+    with urllib.request.urlopen(f"{api_url.rsplit('/', 1)[0]}/stats") as r:
+        return(json.loads(r.read()))
+
+def written_bytes(path):
+    return(sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files))
+
+def run(name, api_url, results):
+    setup(api_url)
+    path = tempfile.mkdtemp(prefix="bench_pipeline_")
+    try:
+        before = server_stats(api_url)
+        start = time.perf_counter()
+        n_tweets = scenarios[name](path)
+        elapsed = time.perf_counter() - start
+        after = server_stats(api_url)
+        results.put({
+            "elapsed": elapsed,
+            "tweets": n_tweets,
+            "requests": after["requests"] - before["requests"] + after["media"] - before["media"],
+            "retried": after["429"] - before["429"] + after["5xx"] - before["5xx"],
+            "written": written_bytes(path),
+            # kilobytes on Linux
+            "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        })
+    # also exit() / SystemExit of a halting function, the parent waits for a result
+    except BaseException as e:
+        results.put({"error": repr(e)})
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+if __name__ == "__main__":
+    pages = load_pages(sys.argv[1]) if len(sys.argv) > 1 else None
+    server, api_url = mock_server.start(pages=pages)
+    print(f"mock server at {api_url}, json backend: {tw.json_loads.__module__}")
+    print(f"{'scenario':30} {'requests/s':>11} {'tweets/s':>10} {'MB written/s':>13} {'peak RSS MB':>12} {'429/5xx':>8}")
+
+    context = multiprocessing.get_context("fork")
+    for name in scenarios:
+        results = context.Queue()
+        process = context.Process(target=run, args=(name, api_url, results))
+        process.start()
+        result = None
+        while result is None:
+            try:
+                result = results.get(timeout=1)
+            except queue.Empty:
+                # killed without a result (e.g. out of memory), once anything it put is read
+                if not process.is_alive():
+                    try:
+                        result = results.get(timeout=1)
+                    except queue.Empty:
+                        result = {"error": f"exit code {process.exitcode}"}
+        process.join()
+        if "error" in result:
+            print(f"{name:30} failed: {result['error']}")
+            continue
+        print(f"{name:30} {result['requests']/result['elapsed']:11.1f} {result['tweets']/result['elapsed']:10.0f} {result['written']/result['elapsed']/2**20:13.1f} {result['peak_rss']/2**20:12.1f} {result['retried']:8}")
+
+    server.terminate()
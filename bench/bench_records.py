@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Memory and throughput of parsed tweets as TweetRecord vs. the 109-key dicts used before.
+#
+#   python bench/bench_records.py [recorded_pages_dir]
+
+import sys
+import os
+import io
+import csv
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import twitter_functions as tw
+from payloads import load_pages
+
+def parse_all(pages):
+    cache = tw.EntityCache()
+    tweets = []
+    for page in pages:
+        tweets.extend(tw.parse_tweets(page, cache))
+    return(tweets)
+
+def held_bytes(build):
+    # bytes allocated by build() that are still alive afterwards
+    tracemalloc.start()
+    held = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return(size, held)
+
+def best_time(run, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return(best)
+
+def write_csv(tweets):
+    f = io.StringIO()
+    writer = csv.writer(f, dialect="unix")
+    writer.writerow(tw.key_names)
+    for parsed_tweet in tweets:
+        writer.writerow(tw.tweet_row(parsed_tweet))
+
+def build_dict(values):
+    # what parse_tweet did before: a fresh 109 key dict, filled one key at a time
+    parsed_tweet = {key: "" for key in tw.key_names}
+    for key, value in zip(tw.key_names, values):
+        parsed_tweet[key] = value
+    return(parsed_tweet)
+
+def build_record(values):
+    parsed_tweet = tw.empty_tweet.copy()
+    for key, value in zip(tw.key_names, values):
+        parsed_tweet[key] = value
+    return(tw.TweetRecord(list(parsed_tweet.values())))
+
+if __name__ == "__main__":
+    pages = [tw.json_loads(p) for p in load_pages(sys.argv[1] if len(sys.argv) > 1 else None)]
+    records = parse_all(pages)
+    values = [list(r.values) for r in records]
+    n = len(records)
+    print(f"{n} tweets from {len(pages)} pages")
+
+    dict_bytes, dicts = held_bytes(lambda: [build_dict(v) for v in values])
+    record_bytes, _ = held_bytes(lambda: [build_record(v) for v in values])
+    print(f"memory held       dict: {dict_bytes/n:7.0f} B/tweet   record: {record_bytes/n:7.0f} B/tweet ({dict_bytes/record_bytes:.1f}x less)")
+
+    dict_build = best_time(lambda: [build_dict(v) for v in values])
+    record_build = best_time(lambda: [build_record(v) for v in values])
+    print(f"build             dict: {n/dict_build:9.0f} tweets/s  record: {n/record_build:9.0f} tweets/s")
+
+    dict_write = best_time(lambda: write_csv(dicts))
+    record_write = best_time(lambda: write_csv(records))
+    print(f"csv write         dict: {n/dict_write:9.0f} tweets/s  record: {n/record_write:9.0f} tweets/s")
+
+    parse = best_time(lambda: parse_all(pages))
+    print(f"parse_tweets (records): {n/parse:9.0f} tweets/s")
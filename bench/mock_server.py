@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Local stand-in for the Twitter v2 endpoints used by twitter_functions, serving synthetic (or recorded)
+# pages from payloads.py. Search pages are chained with next_token, every rate_limit_every-th request
+# gets a 429 with x-rate-limit-reset, every error_every-th a 503, and media URLs point at /media/ on
+# the same server. GET /stats returns the request counters.
+#
+#   python bench/mock_server.py [port] [recorded_pages_dir]
+
+import sys
+import json
+import time
+import threading
+import multiprocessing
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from payloads import make_page, load_pages
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count("bytes", len(body))
+
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+
+        if url.path == "/stats":
+            with server.lock:
+                body = json.dumps(server.counters).encode("utf-8")
+            self.send(200, body)
+            return
+
+        if url.path.startswith("/media/"):
+            server.count("media")
+            self.send(200, server.media_body, content_type="image/jpeg")
+            return
+
+        n = server.count("requests")
+        rate_limit_headers = {"x-rate-limit-limit": "100000", "x-rate-limit-remaining": "99999", "x-rate-limit-reset": str(int(time.time()) + 900)}
+        if server.rate_limit_every and n % server.rate_limit_every == 0:
+            server.count("429")
+            self.send(429, b'{"title": "Too Many Requests"}', headers={"x-rate-limit-limit": "100000", "x-rate-limit-remaining": "0", "x-rate-limit-reset": str(int(time.time()) + 1)})
+            return
+        if server.error_every and n % server.error_every == 0:
+            server.count("5xx")
+            self.send(503, b'{"title": "Service Unavailable"}')
+            return
+
+        if url.path.startswith("/2/tweets/search/"):
+            server.count("search")
+            page = int(params.get("pagination_token", 0))
+            self.send(200, server.search_pages[page % len(server.search_pages)], headers=rate_limit_headers)
+        elif url.path == "/2/tweets":
+            server.count("lookup")
+            ids = params["ids"].split(",")
+            tweets = [dict(tweet, id=tweet_id) for tweet, tweet_id in zip(server.lookup_page["data"], ids)]
+            self.send(200, json.dumps(dict(server.lookup_page, data=tweets)).encode("utf-8"), headers=rate_limit_headers)
+        else:
+            self.send(404, b'{"title": "Not Found"}')
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, pages=None, n_pages=20, n_tweets=500, media_size=100000, rate_limit_every=100, error_every=40):
+        super().__init__(address, MockHandler)
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "search": 0, "lookup": 0, "media": 0, "429": 0, "5xx": 0, "bytes": 0}
+        self.rate_limit_every = rate_limit_every
+        self.error_every = error_every
+        self.media_body = b"\xff" * media_size
+        base_url = f"http://{address[0]}:{self.server_port}"
+
+        # one chain of search pages, the last one without next_token
+        pages = [json.loads(page) for page in pages] if pages else [make_page(n_tweets=n_tweets, seed=n, start_id=1500000000000000000 - n*n_tweets) for n in range(n_pages)]
+        self.search_pages = []
+        for n, page in enumerate(pages):
+            page["meta"].pop("next_token", None)
+            if n + 1 < len(pages):
+                page["meta"]["next_token"] = str(n + 1)
+            body = json.dumps(page).encode("utf-8").replace(b"https://pbs.twimg.com/media/", f"{base_url}/media/".encode("utf-8"))
+            self.search_pages.append(body)
+        self.lookup_page = make_page(n_tweets=100, seed=0)
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+            return(self.counters[counter])
+
+def serve(connection, port=0, **kwargs):
+    server = MockServer(("127.0.0.1", port), **kwargs)
+    connection.send(server.server_port)
+    server.serve_forever()
+
+def start(**kwargs):
+    # runs the server in its own process (so it doesn't share a GIL or RSS with the client) and
+    # returns (process, base url of the API)
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=serve, args=(child,), kwargs=kwargs, daemon=True)
+    process.start()
+    port = parent.recv()
+    return(process, f"http://127.0.0.1:{port}/2")
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    server = MockServer(("127.0.0.1", port), pages=load_pages(sys.argv[2]) if len(sys.argv) > 2 else None)
+    print(f"Serving on http://127.0.0.1:{server.server_port}/2")
+    server.serve_forever()
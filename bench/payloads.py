@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synthetic Twitter v2 search pages, shaped like the responses requested by
+# search_tweets (same tweet.fields/user.fields/media.fields/expansions)
+
+import random
+import json
+import glob
+import os
+import datetime
+
+def make_user(user_id, rng):
+    return({
+        "id": str(user_id),
+        "username": f"user{user_id}",
+        "name": f"User {user_id}",
+        "created_at": "2010-03-01T12:00:00.000Z",
+        "description": " ".join(rng.choice(["data", "science", "news", "politics", "music", "sports"]) for _ in range(12)),
+        "url": "https://t.co/abcdef",
+        "entities": {"url": {"urls": [{"expanded_url": f"https://example.com/{user_id}"}]}},
+        "location": "Berlin",
+        "protected": False,
+        "verified": rng.random() < 0.1,
+        "public_metrics": {
+            "followers_count": rng.randint(0, 100000),
+            "following_count": rng.randint(0, 5000),
+            "tweet_count": rng.randint(0, 200000),
+            "listed_count": rng.randint(0, 1000)
+        }
+    })
+
+def make_tweet(tweet_id, author_id, created_at, rng):
+    text = " ".join(rng.choice(["lorem", "ipsum", "dolor", "sit", "amet", "#data", "@user1"]) for _ in range(rng.randint(5, 40)))
+    return({
+        "id": str(tweet_id),
+        "author_id": str(author_id),
+        "created_at": f"{created_at:%Y-%m-%dT%H:%M:%S}.000Z",
+        "conversation_id": str(tweet_id),
+        "text": text,
+        "lang": "en",
+        "source": "Twitter Web App",
+        "reply_settings": "everyone",
+        "entities": {
+            "hashtags": [{"start": 0, "end": 5, "tag": "data"}],
+            "mentions": [{"start": 6, "end": 12, "username": "user1", "id": "1"}],
+            "urls": [{
+                "start": 13,
+                "end": 36,
+                "url": "https://t.co/abcdef",
+                "expanded_url": "https://example.com/article",
+                "title": "An article",
+                "description": "Something worth reading",
+                "unwound_url": "https://example.com/article"
+            }]
+        },
+        "public_metrics": {
+            "retweet_count": rng.randint(0, 500),
+            "reply_count": rng.randint(0, 100),
+            "like_count": rng.randint(0, 5000),
+            "quote_count": rng.randint(0, 50)
+        }
+    })
+
+def make_page(n_tweets=500, seed=0, next_token=None, start_id=1500000000000000000, end_time=None, n_users=50):
+    rng = random.Random(seed)
+    if end_time is None:
+        end_time = datetime.datetime(2022, 1, 1)
+    users = [make_user(1000 + i, rng) for i in range(n_users)]
+    author = users[0]["id"]
+
+    data = []
+    included_tweets = []
+    media = []
+    for n in range(n_tweets):
+        tweet_id = start_id - n
+        created_at = end_time - datetime.timedelta(minutes=17*n)
+        tweet = make_tweet(tweet_id, author, created_at, rng)
+        kind = rng.random()
+        if kind < 0.3:
+            ref = make_tweet(tweet_id - 10**12, rng.choice(users)["id"], created_at, rng)
+            included_tweets.append(ref)
+            tweet["referenced_tweets"] = [{"type": "retweeted", "id": ref["id"]}]
+        elif kind < 0.45:
+            ref = make_tweet(tweet_id - 10**12, rng.choice(users)["id"], created_at, rng)
+            included_tweets.append(ref)
+            tweet["referenced_tweets"] = [{"type": "replied_to", "id": ref["id"]}]
+            tweet["in_reply_to_user_id"] = ref["author_id"]
+        elif kind < 0.55:
+            ref = make_tweet(tweet_id - 10**12, rng.choice(users)["id"], created_at, rng)
+            included_tweets.append(ref)
+            tweet["referenced_tweets"] = [{"type": "quoted", "id": ref["id"]}]
+        if rng.random() < 0.2:
+            media_key = f"3_{tweet_id}"
+            media.append({
+                "media_key": media_key,
+                "type": "photo",
+                "url": f"https://pbs.twimg.com/media/{media_key}.jpg",
+                "height": 1080,
+                "width": 1920,
+                "alt_text": "A picture"
+            })
+            tweet["attachments"] = {"media_keys": [media_key]}
+        data.append(tweet)
+
+    meta = {
+        "newest_id": data[0]["id"] if data else None,
+        "oldest_id": data[-1]["id"] if data else None,
+        "result_count": len(data)
+    }
+    if next_token:
+        meta["next_token"] = next_token
+
+    return({
+        "data": data,
+        "includes": {"users": users, "tweets": included_tweets, "media": media},
+        "meta": meta
+    })
+
+def load_pages(path=None, n_pages=10, n_tweets=500):
+    # recorded pages (one raw response body per *.json file) if a directory is given
+    if path:
+        pages = []
+        for file_name in sorted(glob.glob(os.path.join(path, "*.json"))):
+            with open(file_name, "rb") as f:
+                pages.append(f.read())
+        return(pages)
+
+    return([json.dumps(make_page(n_tweets=n_tweets, seed=n)).encode("utf-8") for n in range(n_pages)])
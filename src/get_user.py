@@ -3,8 +3,8 @@
 
 import sys
 import os
-import csv
 import twitter_functions as tw
+import user_stats
 from datetime import date, datetime, timedelta
 import logging
 import configparser
@@ -13,6 +13,15 @@ config = configparser.RawConfigParser()
 # Setup API
 config.read("config.ini")
 BEARER_TOKEN = config.get("TWITTER_AUTH", "bearer_token")
+MAX_WORKERS = config.getint("SEARCH", "max_workers", fallback=4)
+ARCHIVE = config.getboolean("SEARCH", "archive", fallback=False)
+TWEETS_PER_WINDOW = config.getint("SEARCH", "tweets_per_window", fallback=5000)
+# JSON summary (*.json) or Prometheus text file of tw.metrics, written after every run
+METRICS_FILE = config.get("SEARCH", "metrics_file", fallback="")
+# comma separated columns of Data/<user>.csv, all of tw.key_names if empty
+COLUMNS = [c.strip() for c in config.get("SEARCH", "columns", fallback="").split(",") if c.strip()] or None
+# gz or zst to keep Data/<user>.csv.gz / .csv.zst instead of the plain CSV
+COMPRESSION = config.get("SEARCH", "compression", fallback="")
 
 logging.getLogger("twitter_functions").setLevel(logging.ERROR)
 
@@ -52,34 +61,101 @@ def daterange(start_date, end_date, days=0, hours=0, months=0, years=0):
                 yield (cur_date, next_date)
             cur_date = next_date
 
-user_name = sys.argv[1]
+def rename_user_files(user_name, data_path="Data"):
+    # files are named after the lower case user name (as gen_stats.R and user_stats.py expect),
+    # those of earlier runs under the name as typed are renamed once. User names have no dots.
+    if not os.path.isdir(data_path):
+        return
+    for name in os.listdir(data_path):
+        prefix, _, rest = name.partition(".")
+        if prefix.lower() == user_name.lower() and prefix != prefix.lower() and not os.path.exists(f"{data_path}/{prefix.lower()}.{rest}"):
+            os.replace(f"{data_path}/{name}", f"{data_path}/{prefix.lower()}.{rest}")
 
-try:
-    file_age = datetime.now().timestamp() - os.path.getmtime(f"Data/{user_name}.csv")
-except:
-    file_age = 172801
+def convert_user_file(user_name, file_name, data_path="Data"):
+    # after a change of [SEARCH] compression, the newest file of the other settings becomes file_name
+    # instead of starting a new backfill (an interrupted backfill is left to finish in its own file)
+    if os.path.exists(file_name):
+        return
+    others = [f for f in [f"{data_path}/{user_name.lower()}.csv", f"{data_path}/{user_name.lower()}.csv.gz", f"{data_path}/{user_name.lower()}.csv.zst"] if f != file_name and os.path.isfile(f) and not tw.has_checkpoint(f)]
+    if others:
+        tw.convert_csv(max(others, key=os.path.getmtime), file_name)
 
-if file_age > (60*60*24*2):
-    tweet_source = "API"
-    users = tw.lookup_users([user_name], bearer_token=BEARER_TOKEN, verbose=False)
-    start_date = datetime.strptime(users[0]["created_at"], "%Y-%m-%dT%H:%M:%S.000Z")
+def get_user(user_name, created_at=None, progress=True, cache=None):
+    # backfills, refreshes or reads Data/<user_name in lower case>.csv, returns (number of tweets,
+    # source). created_at (from a lookup_users result) saves the lookup when a backfill is needed.
+    # The tweets are parsed with cache, an EntityCache of this account only if none is given.
+    if cache is None:
+        cache = tw.EntityCache()
+    rename_user_files(user_name)
+    file_name = f"Data/{user_name.lower()}.csv.{COMPRESSION}" if COMPRESSION else f"Data/{user_name.lower()}.csv"
+    convert_user_file(user_name, file_name)
+    # raw pages for re-parsing without the API (tw.archive_to_csv)
+    archive_path = f"Data/{user_name.lower()}.archive" if ARCHIVE else None
 
-    query = f"from:{user_name}"
-    start_date = datetime(start_date.year, start_date.month, 1, 0, 0, 0)
-    end_date = datetime.now() - timedelta(hours = 24)
+    try:
+        file_age = datetime.now().timestamp() - os.path.getmtime(file_name)
+    except:
+        file_age = 172801
 
-    n_tweets = 0
-    for date_range in daterange(start_date, end_date, months=2):
-        from_date, to_date = date_range
-        tweets = tw.search_tweets(query, bearer_token=BEARER_TOKEN, start_time=f"{from_date:%Y-%m-%dT%H:%M:%SZ}", end_time=f"{to_date:%Y-%m-%dT%H:%M:%SZ}", mode="all", verbose = False)
-        if tweets:
-            n_tweets += len(tweets)
-        tw.tweets_to_csv(tweets, f"Data/{user_name}.csv", verbose = False, append=True)
-        print(f"\tRetrieved {n_tweets} tweets up to {to_date:%Y-%m-%d}", end = "\r")
-else:
-    tweet_source = "cache"
-    with open(f"Data/{user_name}.csv", "r") as f:
-        tweets = csv.reader(f)
-        n_tweets = len([t for t in tweets])-1
+    # an interrupted backfill is resumed before anything else
+    resume = tw.has_checkpoint(file_name)
 
-print(f"\tRetrieved {n_tweets} tweets from {tweet_source}        ")
\ No newline at end of file
+    if resume or file_age > (60*60*24*2):
+        query = f"from:{user_name}"
+        # day aligned, so a resumed backfill plans the same windows as the run it continues
+        today = datetime.now()
+        end_date = datetime(today.year, today.month, today.day) - timedelta(hours = 24)
+
+        _, since_id = tw.csv_tweet_stats(file_name)
+        if since_id and not resume:
+            # only ask for tweets newer than the newest one already stored
+            tweet_source = "API (incremental)"
+            tweets = tw.iter_search_tweets(query, bearer_token=BEARER_TOKEN, since_id=since_id, end_time=f"{end_date:%Y-%m-%dT%H:%M:%SZ}", mode="all", verbose = False, cache=cache, archive=f"{archive_path}/since-{since_id}.jsonl.gz" if archive_path else None, columns=COLUMNS)
+            n_tweets = tw.merge_tweets_csv((t for t in tweets if int(t["status_id"]) > int(since_id)), file_name, columns=COLUMNS)
+            # mark the file as fresh even if there was nothing new to append
+            os.utime(file_name)
+        else:
+            tweet_source = "API (resumed)" if resume else "API"
+            if created_at is None:
+                users = tw.lookup_users([user_name], bearer_token=BEARER_TOKEN, verbose=False)
+                if not users:
+                    raise Exception(f"User {user_name} not found, halting")
+                created_at = users[0]["created_at"]
+            start_date = datetime.strptime(created_at, "%Y-%m-%dT%H:%M:%S.000Z")
+            start_date = datetime(start_date.year, start_date.month, 1, 0, 0, 0)
+
+            n_tweets = 0
+            # windows sized by the counts endpoint, the fixed two month windows if it can't be used
+            windows = tw.planned_windows(file_name) if resume else None
+            if windows is None and not resume:
+                windows = tw.plan_windows(query, BEARER_TOKEN, start_date, end_date, mode="all", tweets_per_window=TWEETS_PER_WINDOW, max_workers=MAX_WORKERS)
+            if windows is None:
+                windows = daterange(start_date, end_date, months=2)
+            for date_range, n_window in tw.backfill_windows(query, BEARER_TOKEN, windows, file_name, mode="all", max_workers=MAX_WORKERS, verbose = False, cache=cache, archive_path=archive_path, columns=COLUMNS):
+                from_date, to_date = date_range
+                n_tweets += n_window
+                if progress:
+                    print(f"\tRetrieved {n_tweets} tweets up to {to_date:%Y-%m-%d}", end = "\r")
+            # sorted by time, without the tweets of overlapping windows
+            n_tweets = tw.merge_tweets_csv([], file_name, columns=COLUMNS)
+    else:
+        tweet_source = "cache"
+        n_tweets, _ = tw.csv_tweet_stats(file_name)
+
+    return(n_tweets, tweet_source)
+
+def write_stats(user_name, tz="UTC"):
+    # Output/<user>_* of the account just written, see user_stats.py
+    if user_stats.pd is None:
+        print("\tNo stats, user_stats.py needs numpy and pandas (pip install numpy pandas)")
+        return
+    print(user_stats.stats_line(user_name, user_stats.user_stats(user_name, tz)))
+
+if __name__ == "__main__":
+    user_name = sys.argv[1]
+    tz = sys.argv[2] if len(sys.argv) > 2 else "UTC"
+    n_tweets, tweet_source = get_user(user_name)
+    print(f"\tRetrieved {n_tweets} tweets from {tweet_source}        ")
+    write_stats(user_name, tz)
+    if METRICS_FILE:
+        tw.metrics.save(METRICS_FILE)
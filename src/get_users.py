@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Batch version of get_user.py: one user name per line in the file given as first argument, the
+# timezone of the stats as optional second argument.
+# All accounts are resolved in batched lookups and updated concurrently over the shared
+# connection pool and rate limits of twitter_functions.
+
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import twitter_functions as tw
+from get_user import get_user, write_stats, config, BEARER_TOKEN, METRICS_FILE
+
+MAX_ACCOUNTS = config.getint("SEARCH", "max_accounts", fallback=4)
+
+with open(sys.argv[1], "r") as f:
+    user_names = [l.strip().lstrip("@") for l in f if l.strip() and not l.startswith("#")]
+tz = sys.argv[2] if len(sys.argv) > 2 else "UTC"
+
+users = {u["screen_name"].lower(): u for u in tw.lookup_users_bulk(user_names, bearer_token=BEARER_TOKEN)}
+for user_name in user_names:
+    if not user_name.lower() in users:
+        print(f"\t@{user_name}: not found")
+# one run per account, under the screen name as the API spells it
+user_names = list(dict.fromkeys(users[u.lower()]["screen_name"] for u in user_names if u.lower() in users))
+
+n_done = 0
+with ThreadPoolExecutor(max_workers=MAX_ACCOUNTS) as executor:
+    # one EntityCache per account, the accounts don't share entities or a lock
+    futures = {executor.submit(get_user, user_name, users[user_name.lower()]["created_at"], False, tw.EntityCache()): user_name for user_name in user_names}
+    for future in as_completed(futures):
+        n_done += 1
+        user_name = futures[future]
+        try:
+            n_tweets, tweet_source = future.result()
+            print(f"\t[{n_done}/{len(user_names)}] @{user_name}: {n_tweets} tweets from {tweet_source}")
+        except (Exception, SystemExit) as e:
+            print(f"\t[{n_done}/{len(user_names)}] @{user_name}: failed ({e!r}), rerun to resume")
+            continue
+        # on this thread while the other accounts are still being fetched
+        write_stats(user_name, tz)
+
+if METRICS_FILE:
+    tw.metrics.save(METRICS_FILE)
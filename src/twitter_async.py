@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# asyncio versions of the network calls in twitter_functions, for running many requests at once
+# without a thread per request. Requests go through one pooled httpx.AsyncClient (keep-alive, and
+# HTTP/2 if h2 is installed: pip install httpx[http2]) and take their tokens from the same rate
+# limiters as the blocking functions. Responses are parsed by twitter_functions.
+#
+#   async with AsyncClient(bearer_token) as client:
+#       tweets = await client.search_tweets("from:user", start_time="2022-01-01T00:00:00Z", mode="all")
+
+import asyncio
+import os
+import time
+import twitter_functions as tw
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import h2
+except ImportError:
+    h2 = None
+
+logger = tw.logger
+
+class AsyncClient:
+    def __init__(self, bearer_token, max_connections=100, http2=True, rate_limits=None, cache=None):
+        if httpx is None:
+            raise Exception("AsyncClient needs httpx (pip install httpx), halting")
+        self.rate_limits = rate_limits or tw.rate_limits
+        self.cache = cache
+        self.headers = {
+            "Authorization": "Bearer {}".format(bearer_token),
+        }
+        # retries only cover failed connects, error responses are retried in request()
+        transport = httpx.AsyncHTTPTransport(
+            http2=http2 and h2 is not None,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            retries=3
+        )
+        self.client = httpx.AsyncClient(transport=transport, timeout=httpx.Timeout(30, read=60))
+
+    async def __aenter__(self):
+        return(self)
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def request(self, endpoint, url, params=None):
+        # rate limited GET, like RateLimitManager.request: waits for a token, backs off on 429,
+        # and retries 5xx responses
+        limiter = self.rate_limits.limiter(endpoint)
+        for attempt in range(self.rate_limits.max_retries + 1):
+            while True:
+                wait_time = limiter.try_acquire()
+                if wait_time <= 0:
+                    break
+                tw.metrics.inc("sleep_seconds_total", wait_time, endpoint=endpoint, reason=limiter.wait_reason())
+                await asyncio.sleep(wait_time)
+            start = time.perf_counter()
+            r = await self.client.get(url, headers=self.headers, params=params)
+            tw.metrics.observe("request_seconds", time.perf_counter() - start, endpoint=endpoint)
+            tw.metrics.inc("requests_total", endpoint=endpoint, status=r.status_code)
+            tw.metrics.inc("response_bytes_total", len(r.content), endpoint=endpoint)
+            limiter.update(r.headers)
+            if r.status_code == 429:
+                self.rate_limits.throttle(endpoint, r.headers, attempt)
+            elif r.status_code in (500, 502, 503, 504):
+                logger.warning(f"Error on {endpoint} (status code: {r.status_code}), retrying (attempt {attempt + 1} of {self.rate_limits.max_retries + 1})")
+                backoff = min(self.rate_limits.backoff_factor * 2**attempt, self.rate_limits.max_backoff)
+                tw.metrics.inc("sleep_seconds_total", backoff, endpoint=endpoint, reason="retry")
+                await asyncio.sleep(backoff)
+            else:
+                return(r)
+
+        logger.error(f"Giving up on {endpoint} after {self.rate_limits.max_retries + 1} attempts")
+        return(r)
+
+    async def iter_search_pages(self, query, since_id=None, until_id=None, start_time=None, end_time=None, mode="recent", pagination_token=None, columns=None):
+        # yields decoded pages of a search, following next_token
+        if len(query) > 1024:
+            raise Exception("Query too long, halting")
+        columns = tw.column_selection(columns)
+        params = (
+            ("query", query),
+            ("max_results", 500),
+        ) + (tw.tweet_params if columns is None else columns.params)
+        for name, value in (("since_id", since_id), ("until_id", until_id), ("start_time", start_time), ("end_time", end_time)):
+            if value:
+                params = params + ((name, value),)
+        if not start_time and not since_id:
+            logger.warning(f"No start_time and no since_id was set. By default, a request will return Tweets from up to 30 days ago if you do not include this parameter.")
+
+        next_token = pagination_token
+        while True:
+            r = await self.request(f"tweets/search/{mode}", f"{tw.api_url}/tweets/search/{mode}", params=params + (("pagination_token", next_token),) if next_token else params)
+            if (r.status_code != 200):
+                raise Exception(f"Error getting tweets (status code: {r.status_code}, {next_token=})")
+            page = tw.decode_response(r)
+            if page["meta"]["result_count"] > 0:
+                yield(page)
+            next_token = page["meta"].get("next_token")
+            if not next_token:
+                break
+
+    async def iter_search_tweets(self, query, since_id=None, until_id=None, start_time=None, end_time=None, mode="recent", columns=None):
+        columns = tw.column_selection(columns)
+        async for page in self.iter_search_pages(query, since_id=since_id, until_id=until_id, start_time=start_time, end_time=end_time, mode=mode, columns=columns):
+            for parsed_tweet in tw.parse_tweets(page, self.cache, columns):
+                yield(parsed_tweet)
+
+    async def search_tweets(self, query, since_id=None, until_id=None, start_time=None, end_time=None, mode="recent", columns=None):
+        searched_tweets = [t async for t in self.iter_search_tweets(query, since_id=since_id, until_id=until_id, start_time=start_time, end_time=end_time, mode=mode, columns=columns)]
+        if not searched_tweets:
+            logger.warning(f"No tweets found")
+            return(None)
+        logger.info(f"Retrieved {len(searched_tweets)} tweets ({tw.get_datetime_range(searched_tweets)})")
+        return(searched_tweets)
+
+    async def lookup_batch(self, endpoint, url, params):
+        r = await self.request(endpoint, url, params=params)
+        if (r.status_code != 200):
+            raise Exception(f"Error on {endpoint} (status code: {r.status_code})")
+        return(tw.decode_response(r))
+
+    async def lookup_tweets(self, tweet_ids, columns=None):
+        # any number of ids, all batches of 100 at once. Parsed tweets in the order of tweet_ids,
+        # ids that were not found are skipped
+        columns = tw.column_selection(columns)
+        params = tw.tweet_params if columns is None else columns.params
+        batches = list(tw.unique_batches(str(i) for i in tweet_ids))
+        pages = await asyncio.gather(*(self.lookup_batch("tweets", f"{tw.api_url}/tweets", (("ids", ",".join(batch)),) + params) for batch in batches))
+        queried_tweets = []
+        for batch, page in zip(batches, pages):
+            if not "data" in page:
+                continue
+            by_id = {t["status_id"]: t for t in tw.parse_tweets(page, self.cache, columns)}
+            queried_tweets.extend(by_id[tweet_id] for tweet_id in batch if tweet_id in by_id)
+        return(queried_tweets)
+
+    async def lookup_users(self, user_names):
+        # any number of user names, all batches of 100 at once. Parsed users in the order of
+        # user_names, names that were not found are skipped
+        batches = list(tw.unique_batches(user_names, key=str.lower))
+        pages = await asyncio.gather(*(self.lookup_batch("users/by", f"{tw.api_url}/users/by", (("usernames", ",".join(batch)),) + tw.user_params) for batch in batches))
+        queried_users = []
+        for batch, page in zip(batches, pages):
+            if not "data" in page:
+                continue
+            by_name = {u["screen_name"].lower(): u for u in tw.parse_users(page)}
+            queried_users.extend(by_name[user_name.lower()] for user_name in batch if user_name.lower() in by_name)
+        return(queried_users)
+
+    async def lookup_retweet_users(self, tweet_id):
+        # every user that retweeted tweet_id, following next_token (see twitter_functions.iter_retweet_users)
+        queried_users = []
+        next_token = None
+        while True:
+            params = tw.user_params + (("max_results", 100),)
+            page = await self.lookup_batch("tweets/:id/retweeted_by", f"{tw.api_url}/tweets/{tweet_id}/retweeted_by", params + (("pagination_token", next_token),) if next_token else params)
+            if "data" in page:
+                for parsed_user in tw.parse_users(page):
+                    parsed_user["retweeted_status_id"] = str(tweet_id)
+                    queried_users.append(parsed_user)
+            next_token = page.get("meta", {}).get("next_token")
+            if not next_token:
+                break
+        return(queried_users)
+
+    async def media_download(self, queried_tweets, base_path=".", media_types=("photo",), max_concurrency=32):
+        # same files and manifest.csv as twitter_functions.media_download
+        if not os.path.exists(f"{base_path}"):
+            logger.warning(f"base_path does not exist, creating {base_path}")
+            os.makedirs(f"{base_path}")
+
+        manifest_file = f"{base_path}/manifest.csv"
+        media = tw.collect_media(queried_tweets, media_types, skip=tw.manifest_keys(manifest_file))
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def download(media_key):
+            media_type, media_url = media[media_key]
+            file_name = tw.media_file(base_path, media_key, media_url)
+            if not os.path.exists(file_name):
+                try:
+                    async with semaphore:
+                        async with self.client.stream("GET", media_url) as r:
+                            if r.status_code != 200:
+                                logger.error(f"Error downloading media {media_key} (status code: {r.status_code})")
+                                return(False)
+                            with open(f"{file_name}.part", "wb") as f:
+                                async for chunk in r.aiter_bytes(chunk_size=65536):
+                                    f.write(chunk)
+                    os.replace(f"{file_name}.part", file_name)
+                except Exception as e:
+                    logger.error(f"Error downloading media {media_key} (Error: {e})")
+                    if os.path.exists(f"{file_name}.part"):
+                        os.remove(f"{file_name}.part")
+                    return(False)
+            # single threaded, no lock needed around the manifest
+            tw.add_to_manifest(manifest_file, media_key, media_type, media_url, file_name)
+            return(True)
+
+        n_downloaded = sum(await asyncio.gather(*(download(media_key) for media_key in media)))
+        logger.info(f"Downloaded {n_downloaded} of {len(media)} media files")
+        return(n_downloaded)
@@ -7,12 +7,43 @@ from requests.adapters import HTTPAdapter
 import datetime
 import math
 import csv
+import itertools
+import functools
+import heapq
+import bisect
+import operator
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import io
+import gzip
 import json
 import traceback
 import time
 import os
+import shutil
+import urllib.parse
+import re
+import sqlite3
 import logging
 
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 logger = logging.getLogger(__name__)
 handler = logging.StreamHandler()
 formatter = logging.Formatter(
@@ -21,45 +52,502 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 logger.setLevel(logging.WARNING)
 
+# base of every API request, e.g. a local mock server in bench/
+api_url = "https://api.twitter.com/2"
+
 request_session = requests.Session()
 retry_strategy = Retry(
     total=10,
     backoff_factor=5,
     status_forcelist=[500, 502, 503, 504]
 )
-adapter = HTTPAdapter(max_retries=retry_strategy)
+adapter = HTTPAdapter(max_retries=retry_strategy, pool_maxsize=16)
 request_session.mount("https://", adapter)
 
-user_dict = {}
-included_tweets_dict = {}
-places_dict = {}
-media_dict = {}
+class Metrics:
+    # counters and histograms of the hot paths, shared by all threads. summary() for a dict,
+    # to_json / to_prometheus to export them. Work done in worker processes is not counted.
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if not key in self.histograms:
+                self.histograms[key] = {"buckets": [0] * len(self.buckets), "sum": 0, "count": 0}
+            histogram = self.histograms[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.time() - self.started
+            counters = [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(self.counters.items())]
+            histograms = [{"name": name, "labels": dict(labels), "count": h["count"], "sum": h["sum"], "mean": h["sum"] / h["count"], "buckets": dict(zip(self.buckets, h["buckets"]))} for (name, labels), h in sorted(self.histograms.items())]
+        n_written = sum(c["value"] for c in counters if c["name"] == "tweets_written_total")
+        n_parsed = sum(c["value"] for c in counters if c["name"] == "tweets_parsed_total")
+        return({
+            "elapsed_seconds": elapsed,
+            "tweets_parsed_per_second": n_parsed / elapsed if elapsed > 0 else 0,
+            "tweets_written_per_second": n_written / elapsed if elapsed > 0 else 0,
+            "counters": counters,
+            "histograms": histograms
+        })
+
+    def prometheus(self, prefix="twitter_"):
+        def label_text(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return("")
+            return("{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}")
+
+        with self.lock:
+            lines = [f"# TYPE {prefix}elapsed_seconds gauge", f"{prefix}elapsed_seconds {time.time() - self.started}"]
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if not name in typed:
+                    lines.append(f"# TYPE {prefix}{name} counter")
+                    typed.add(name)
+                lines.append(f"{prefix}{name}{label_text(labels)} {value}")
+            for (name, labels), h in sorted(self.histograms.items()):
+                if not name in typed:
+                    lines.append(f"# TYPE {prefix}{name} histogram")
+                    typed.add(name)
+                for bound, n in zip(self.buckets, h["buckets"]):
+                    lines.append(f"{prefix}{name}_bucket{label_text(labels, [('le', bound)])} {n}")
+                lines.append(f"{prefix}{name}_bucket{label_text(labels, [('le', '+Inf')])} {h['count']}")
+                lines.append(f"{prefix}{name}_sum{label_text(labels)} {h['sum']}")
+                lines.append(f"{prefix}{name}_count{label_text(labels)} {h['count']}")
+        return("\n".join(lines) + "\n")
+
+    def save(self, file_name):
+        # JSON summary for *.json, Prometheus text format (e.g. for node_exporter's textfile collector)
+        # otherwise. Written and renamed, a scraper never reads half a file
+        with open(f"{file_name}.tmp", "w") as f:
+            if file_name.endswith(".json"):
+                json.dump(self.summary(), f, indent=2)
+            else:
+                f.write(self.prometheus())
+        os.replace(f"{file_name}.tmp", file_name)
+
+metrics = Metrics()
+
+class RateLimiter:
+    # token bucket shared by all threads, synced from the x-rate-limit-* headers of every response
+    def __init__(self, limit=300, window=900, min_interval=0, name=""):
+        self.lock = threading.Lock()
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self.min_interval = min_interval
+        self.remaining = limit
+        self.reset = time.time() + window
+        self.last_request = 0
+
+    def try_acquire(self):
+        # takes a token and returns 0, or returns the seconds to wait before trying again
+        with self.lock:
+            now = time.time()
+            if now >= self.reset:
+                self.remaining = self.limit
+                self.reset = now + self.window
+            wait_time = self.last_request + self.min_interval - now
+            if self.remaining <= 0:
+                wait_time = max(wait_time, self.reset - now + 1)
+            if wait_time <= 0:
+                self.remaining -= 1
+                self.last_request = now
+                return(0)
+            return(wait_time)
+
+    def acquire(self):
+        while True:
+            wait_time = self.try_acquire()
+            if wait_time <= 0:
+                return
+            metrics.inc("sleep_seconds_total", wait_time, endpoint=self.name, reason=self.wait_reason())
+            time.sleep(wait_time)
+
+    def wait_reason(self):
+        # out of calls, or only kept apart by min_interval
+        return("rate_limit" if self.remaining <= 0 else "pacing")
+
+    def update(self, headers):
+        try:
+            limit = int(headers["x-rate-limit-limit"])
+            remaining = int(headers["x-rate-limit-remaining"])
+            reset = int(headers["x-rate-limit-reset"])
+        except (KeyError, ValueError):
+            return
+        with self.lock:
+            self.limit = limit
+            if reset > self.reset + 1:
+                # a new window started since the last response
+                self.remaining = remaining
+            else:
+                # requests still in flight have already taken their token
+                self.remaining = min(self.remaining, remaining)
+            self.reset = reset
+
+    def block(self, reset):
+        # no calls left until reset, every thread waits in acquire
+        with self.lock:
+            self.remaining = 0
+            self.reset = reset
+
+    def state(self):
+        with self.lock:
+            return({"limit": self.limit, "remaining": self.remaining, "reset": int(self.reset)})
+
+class RateLimitManager:
+    # one RateLimiter per endpoint, every request goes through request() so 429s are the exception
+    def __init__(self, max_retries=5, backoff_factor=15, max_backoff=900):
+        self.lock = threading.Lock()
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.limiters = {}
+        # (calls per window, window in seconds, seconds between calls) until the first response arrives
+        self.defaults = {
+            "tweets/search/all": (300, 900, 1),
+            "tweets/search/recent": (450, 900, 0),
+            "tweets/counts/all": (300, 900, 1),
+            "tweets/counts/recent": (300, 900, 0),
+            "tweets": (300, 900, 0),
+            "users/by": (300, 900, 0),
+            "tweets/:id/retweeted_by": (75, 900, 0)
+        }
+
+    def limiter(self, endpoint):
+        with self.lock:
+            if not endpoint in self.limiters:
+                limit, window, min_interval = self.defaults.get(endpoint, (300, 900, 0))
+                self.limiters[endpoint] = RateLimiter(limit=limit, window=window, min_interval=min_interval, name=endpoint)
+            return(self.limiters[endpoint])
+
+    def state(self):
+        with self.lock:
+            limiters = dict(self.limiters)
+        return({endpoint: limiter.state() for endpoint, limiter in limiters.items()})
+
+    def request(self, endpoint, url, **kwargs):
+        limiter = self.limiter(endpoint)
+        for attempt in range(self.max_retries + 1):
+            limiter.acquire()
+            start = time.perf_counter()
+            r = request_session.get(url, **kwargs)
+            metrics.observe("request_seconds", time.perf_counter() - start, endpoint=endpoint)
+            metrics.inc("requests_total", endpoint=endpoint, status=r.status_code)
+            metrics.inc("response_bytes_total", len(r.content), endpoint=endpoint)
+            limiter.update(r.headers)
+            if r.status_code != 429:
+                return(r)
+            self.throttle(endpoint, r.headers, attempt)
+
+        logger.error(f"Rate limit exceeded on {endpoint}, giving up after {self.max_retries + 1} attempts")
+        return(r)
+
+    def throttle(self, endpoint, headers, attempt):
+        # after a 429: no calls until the reset of the response, or exponential backoff without one
+        try:
+            reset = int(headers["x-rate-limit-reset"]) + 1
+        except (KeyError, ValueError):
+            reset = 0
+        now = time.time()
+        if reset <= now:
+            reset = now + min(self.backoff_factor * 2**attempt, self.max_backoff)
+        else:
+            reset = min(reset, now + self.max_backoff)
+        self.limiter(endpoint).block(reset)
+        logger.warning(f"Rate limit exceeded on {endpoint}, resuming in {math.ceil(reset - now)} seconds (attempt {attempt + 1} of {self.max_retries + 1})")
+
+rate_limits = RateLimitManager()
+
+class BoundedDict:
+    # dict with least recently used eviction and an optional time to live in seconds
+    def __init__(self, max_size=100000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = collections.OrderedDict()
+
+    def __contains__(self, key):
+        if not key in self.items:
+            return(False)
+        if self.ttl is not None and time.time() - self.items[key][1] > self.ttl:
+            del self.items[key]
+            return(False)
+        return(True)
+
+    def __getitem__(self, key):
+        if not key in self:
+            raise KeyError(key)
+        self.items.move_to_end(key)
+        return(self.items[key][0])
+
+    def __setitem__(self, key, value):
+        self.items[key] = (value, time.time())
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def __len__(self):
+        return(len(self.items))
+
+    def clear(self):
+        self.items.clear()
+
+class EntityCache:
+    # users, tweets, places and media from the includes of a response, looked up by parse_tweet.
+    # max_size has to hold the includes of at least one page (500 tweets), a ttl makes
+    # entities like follower counts get refreshed from newer pages.
+    def __init__(self, max_size=100000, ttl=None):
+        self.lock = threading.RLock()
+        self.users = BoundedDict(max_size, ttl)
+        self.tweets = BoundedDict(max_size, ttl)
+        self.places = BoundedDict(max_size, ttl)
+        self.media = BoundedDict(max_size, ttl)
+
+    def clear(self):
+        with self.lock:
+            self.users.clear()
+            self.tweets.clear()
+            self.places.clear()
+            self.media.clear()
+
+# used when no cache is passed to the parsers
+entity_cache = EntityCache()
+
 queried_at = int(datetime.datetime.now().timestamp())
 
+user_key_names = ["user_id", "screen_name", "name", "created_at", "description", "url", "location", "followers_count", "following_count", "tweet_count", "listed_count", "protected", "verified", "withheld", "pinned_tweet_id", "queried_at"]
+
 key_names = ["status_id", "created_at", "text", "conversation_id", "hashtags", "mentions", "url_location", "url_unwound", "url_title", "url_description", "url_sensitive", "media_key", "media_type", "media_url", "media_duration", "media_height", "media_width", "media_alt", "geo", "lang", "source", "reply_settings", "retweet_count", "reply_count", "like_count", "quote_count", "is_retweet", "is_reply", "is_quote", "retweeted_user_id", "retweeted_user_screen_name", "retweeted_user_name", "retweeted_user_followers_count", "retweeted_user_following_count", "retweeted_user_tweet_count", "retweeted_user_listed_count", "retweeted_user_protected", "retweeted_user_verified", "retweeted_user_description", "retweeted_tweet_status_id", "retweeted_tweet_conversation_id", "retweeted_tweet_created_at", "retweeted_tweet_lang", "retweeted_tweet_source", "retweeted_tweet_text", "retweeted_tweet_retweet_count", "retweeted_tweet_reply_count", "retweeted_tweet_like_count", "retweeted_tweet_quote_count", "replied_user_id", "replied_user_screen_name", "replied_user_name", "replied_user_followers_count", "replied_user_following_count", "replied_user_tweet_count", "replied_user_listed_count", "replied_user_protected", "replied_user_verified", "replied_user_description", "replied_tweet_status_id", "replied_tweet_conversation_id", "replied_tweet_created_at", "replied_tweet_lang", "replied_tweet_source", "replied_tweet_text", "replied_tweet_retweet_count", "replied_tweet_reply_count", "replied_tweet_like_count", "replied_tweet_quote_count", "quoted_user_id", "quoted_user_screen_name", "quoted_user_name", "quoted_user_followers_count", "quoted_user_following_count", "quoted_user_tweet_count", "quoted_user_listed_count", "quoted_user_protected", "quoted_user_verified", "quoted_user_description", "quoted_tweet_status_id", "quoted_tweet_conversation_id", "quoted_tweet_created_at", "quoted_tweet_lang", "quoted_tweet_source", "quoted_tweet_text", "quoted_tweet_retweet_count", "quoted_tweet_reply_count", "quoted_tweet_like_count", "quoted_tweet_quote_count", "geo_id", "geo_full_name", "geo_name", "geo_country", "geo_country_code", "geo_place_type", "geo_json", "user_id", "screen_name", "name", "account_created_at", "description", "url", "location", "followers_count", "following_count", "tweet_count", "listed_count", "protected", "verified", "queried_at"]
 
+# fields and expansions of every tweet search and lookup, and of every user lookup
+tweet_params = (
+    ("tweet.fields", "author_id,created_at,conversation_id,text,lang,geo,entities,reply_settings,public_metrics,source,referenced_tweets"),
+    ("user.fields", "id,name,username,created_at,description,url,location,protected,verified,public_metrics,entities"),
+    ("media.fields", "media_key,type,url,duration_ms,height,width,alt_text,variants"),
+    ("expansions", "referenced_tweets.id,referenced_tweets.id.author_id,in_reply_to_user_id,author_id,attachments.media_keys,entities.mentions.username,geo.place_id")
+)
+user_params = (
+    ("user.fields", "id,name,username,created_at,description,url,location,protected,verified,public_metrics,entities,pinned_tweet_id,withheld"),
+)
+
+def decode_response(r):
+    # decode the body once and pass the dict around, r.json() re-decodes on every call
+    return(json_loads(r.content))
+
+def page_meta(content):
+    # meta of an undecoded page body, for the raw pages of iter_search_pages. The API writes it
+    # after data and includes, so only that tail is decoded; the whole body if it isn't there.
+    start = content.rfind(b'"meta"')
+    if start > 0 and content[start - 1:start] != b"\\":
+        tail = content[start + 6:].lstrip()
+        if tail[:1] == b":":
+            try:
+                meta, _ = json.JSONDecoder().raw_decode(tail[1:].lstrip().decode())
+                if isinstance(meta, dict) and "result_count" in meta:
+                    return(meta)
+            except ValueError:
+                pass
+    return(json_loads(content)["meta"])
+
+empty_tweet = dict.fromkeys(key_names, "")
+
+# (column suffix, field of the included tweet) copied for every type of referenced tweet, the
+# included tweets in the cache hold the author's user fields next to the tweet fields
+reference_fields = [
+    ("user_id", "user_id"),
+    ("user_screen_name", "screen_name"),
+    ("user_name", "name"),
+    ("user_followers_count", "followers_count"),
+    ("user_following_count", "following_count"),
+    ("user_tweet_count", "tweet_count"),
+    ("user_listed_count", "listed_count"),
+    ("user_protected", "protected"),
+    ("user_verified", "verified"),
+    ("user_description", "description"),
+    ("tweet_conversation_id", "conversation_id"),
+    ("tweet_created_at", "created_at"),
+    ("tweet_lang", "lang"),
+    ("tweet_source", "source"),
+    ("tweet_text", "text"),
+    ("tweet_retweet_count", "retweet_count"),
+    ("tweet_reply_count", "reply_count"),
+    ("tweet_like_count", "like_count"),
+    ("tweet_quote_count", "quote_count")
+]
+reference_getter = operator.itemgetter(*[field for _, field in reference_fields])
+# referenced tweet type -> (status id column, columns in the order of reference_fields)
+reference_columns = {
+    reference_type: (f"{prefix}_tweet_status_id", [f"{prefix}_{suffix}" for suffix, _ in reference_fields])
+    for reference_type, prefix in [("quoted", "quoted"), ("retweeted", "retweeted"), ("replied_to", "replied")]
+}
+key_index = {key: n for n, key in enumerate(key_names)}
+
+# fields of the included tweets and their authors, copied into the columns of reference_fields
+reference_params = {
+    "tweet.fields": ["referenced_tweets", "author_id", "created_at", "conversation_id", "text", "lang", "source", "public_metrics"],
+    "user.fields": dict(tweet_params)["user.fields"].split(","),
+    "expansions": ["referenced_tweets.id", "referenced_tweets.id.author_id", "in_reply_to_user_id"]
+}
+# parse step of parse_tweet -> (columns it fills, request parameters it needs). status_id,
+# created_at and queried_at are set for every tweet.
+parse_steps = {
+    "text": (["text"], {"tweet.fields": ["text"]}),
+    "conversation_id": (["conversation_id"], {"tweet.fields": ["conversation_id"]}),
+    "hashtags": (["hashtags"], {"tweet.fields": ["entities"]}),
+    "mentions": (["mentions"], {"tweet.fields": ["entities"], "expansions": ["entities.mentions.username"]}),
+    "urls": (["url_location", "url_unwound", "url_title", "url_description", "url_sensitive"], {"tweet.fields": ["entities"]}),
+    "media": (["media_key", "media_type", "media_url", "media_duration", "media_height", "media_width", "media_alt"], {"media.fields": dict(tweet_params)["media.fields"].split(","), "expansions": ["attachments.media_keys"]}),
+    "geo": (["geo", "geo_id", "geo_full_name", "geo_name", "geo_country", "geo_country_code", "geo_place_type", "geo_json"], {"tweet.fields": ["geo"], "expansions": ["geo.place_id"]}),
+    "lang": (["lang"], {"tweet.fields": ["lang"]}),
+    "source": (["source"], {"tweet.fields": ["source"]}),
+    "reply_settings": (["reply_settings"], {"tweet.fields": ["reply_settings"]}),
+    "public_metrics": (["retweet_count", "reply_count", "like_count", "quote_count"], {"tweet.fields": ["public_metrics"]}),
+    # ids of referenced tweets. The included tweets are requested too: a reply whose parent
+    # wasn't included (deleted or protected) doesn't count, whatever columns are selected.
+    "references": (["is_retweet", "is_reply", "is_quote"] + [status_id_column for status_id_column, _ in reference_columns.values()], {"tweet.fields": ["referenced_tweets"], "expansions": ["referenced_tweets.id"]}),
+    "quoted": (reference_columns["quoted"][1], reference_params),
+    "retweeted": (reference_columns["retweeted"][1], reference_params),
+    "replied_to": (reference_columns["replied_to"][1], reference_params),
+    "user": (["user_id", "screen_name", "name", "account_created_at", "description", "url", "location", "followers_count", "following_count", "tweet_count", "listed_count", "protected", "verified"], {"tweet.fields": ["author_id"], "user.fields": dict(tweet_params)["user.fields"].split(","), "expansions": ["author_id"]})
+}
+column_steps = {column: step for step, (columns, _) in parse_steps.items() for column in columns}
+
+class ColumnSelection:
+    # subset of key_names to request, parse and write. Records keep all columns, the ones that
+    # weren't selected stay "". Only the parse steps of the selected columns run and only their
+    # fields and expansions are requested (params replaces tweet_params).
+    def __init__(self, columns):
+        unknown = [column for column in columns if not column in key_index]
+        if unknown:
+            raise Exception(f"Unknown columns: {', '.join(unknown)}, halting")
+        selected = set(columns) | {"status_id", "created_at", "queried_at"}
+        self.columns = [key for key in key_names if key in selected]
+        self.steps = {column_steps[column] for column in self.columns if column in column_steps}
+        if self.steps & {"quoted", "retweeted", "replied_to"}:
+            self.steps.add("references")
+        self.getter = operator.itemgetter(*[key_index[column] for column in self.columns])
+
+        needed = {"tweet.fields": {"created_at"}}
+        for step in self.steps:
+            for name, values in parse_steps[step][1].items():
+                needed.setdefault(name, set()).update(values)
+        # in the order of tweet_params, all columns give tweet_params
+        self.params = tuple((name, ",".join(v for v in value.split(",") if v in needed[name])) for name, value in tweet_params if name in needed)
+
+    def __repr__(self):
+        return(f"ColumnSelection({self.columns!r})")
+
+def column_selection(columns):
+    # None (all columns), a ColumnSelection or a list of column names
+    if columns is None or isinstance(columns, ColumnSelection):
+        return(columns)
+    return(ColumnSelection(columns))
+
+all_steps = set(parse_steps)
+
+class TweetRecord:
+    # parsed tweet as one list of values in key_names order, indexed by column name like a dict
+    __slots__ = ("values",)
+
+    def __init__(self, values=None):
+        self.values = values if values is not None else [""] * len(key_names)
+
+    def __getitem__(self, key):
+        return(self.values[key_index[key]])
+
+    def __setitem__(self, key, value):
+        self.values[key_index[key]] = value
+
+    def __contains__(self, key):
+        return(key in key_index)
+
+    def __iter__(self):
+        return(iter(key_names))
+
+    def __len__(self):
+        return(len(key_names))
+
+    def __eq__(self, other):
+        if isinstance(other, TweetRecord):
+            return(self.values == other.values)
+        return(self.to_dict() == other)
+
+    def __repr__(self):
+        return(f"TweetRecord({self.to_dict()!r})")
+
+    def keys(self):
+        return(key_names)
+
+    def items(self):
+        return(zip(key_names, self.values))
+
+    def get(self, key, default=None):
+        if key in key_index:
+            return(self.values[key_index[key]])
+        return(default)
+
+    def to_dict(self):
+        return(dict(zip(key_names, self.values)))
+
+def tweet_row(parsed_tweet, columns=None):
+    # CSV row in key_names order (or in the order of a ColumnSelection), records are written
+    # without a lookup per column
+    if isinstance(parsed_tweet, TweetRecord):
+        return(parsed_tweet.values if columns is None else list(columns.getter(parsed_tweet.values)))
+    return([parsed_tweet[k] for k in tweet_header(columns)])
+
+def tweet_header(columns=None):
+    return(key_names if columns is None else columns.columns)
+
 def get_datetime_range(tweets):
     values = [t["created_at"] for t in tweets]
     return(f"created_at from {min(values)} to {max(values)}")
 
-def parse_tweet(raw_tweet):
+def parse_tweet(raw_tweet, cache=None, columns=None):
+    if cache is None:
+        cache = entity_cache
+    steps = all_steps if columns is None else column_selection(columns).steps
 
-    parsed_tweet = {key: "" for key in key_names}
+    # copying the template is cheaper than building the 109 keys for every tweet
+    parsed_tweet = empty_tweet.copy()
 
     parsed_tweet["status_id"] = raw_tweet["id"]
     parsed_tweet["created_at"] = raw_tweet["created_at"]
-    parsed_tweet["text"] = raw_tweet["text"]
-    parsed_tweet["conversation_id"] = raw_tweet["conversation_id"]
+    if "text" in steps:
+        parsed_tweet["text"] = raw_tweet["text"]
+    if "conversation_id" in steps:
+        parsed_tweet["conversation_id"] = raw_tweet["conversation_id"]
 
     # entities
     if "entities" in raw_tweet.keys():
-        if "hashtags" in raw_tweet["entities"].keys():
+        if "hashtags" in raw_tweet["entities"].keys() and "hashtags" in steps:
             parsed_tweet["hashtags"] = json.dumps([i["tag"] for i in raw_tweet["entities"]["hashtags"]])
         
-        if "mentions" in raw_tweet["entities"].keys():
+        if "mentions" in raw_tweet["entities"].keys() and "mentions" in steps:
             parsed_tweet["mentions"] = json.dumps([i["username"] for i in raw_tweet["entities"]["mentions"]])
 
-        if "urls" in raw_tweet["entities"].keys():
+        if "urls" in raw_tweet["entities"].keys() and "urls" in steps:
             try:
                 parsed_tweet["url_location"] = json.dumps([i["expanded_url"] for i in raw_tweet["entities"]["urls"]])
             except:
@@ -89,19 +577,20 @@ def parse_tweet(raw_tweet):
     
     # geo, needs testing
     # Check: https://developer.twitter.com/en/docs/twitter-api/data-dictionary/object-model/place
-    try:
-        parsed_tweet["geo_id"] = raw_tweet["geo"]["place_id"]
-        parsed_tweet["geo_full_name"] = places_dict[raw_tweet["geo"]["place_id"]]["full_name"]
-        parsed_tweet["geo_name"] = places_dict[raw_tweet["geo"]["place_id"]]["name"]
-        parsed_tweet["geo_country"] = places_dict[raw_tweet["geo"]["place_id"]]["country"]
-        parsed_tweet["geo_country_code"] = places_dict[raw_tweet["geo"]["place_id"]]["country_code"]
-        parsed_tweet["place_type"] = places_dict[raw_tweet["geo"]["place_id"]]["geo_place_type"]
-        parsed_tweet["geo_json"] = places_dict[raw_tweet["geo"]["place_id"]]["geo_json"]
-    except:
-        pass
+    if "geo" in steps:
+        try:
+            parsed_tweet["geo_id"] = raw_tweet["geo"]["place_id"]
+            parsed_tweet["geo_full_name"] = cache.places[raw_tweet["geo"]["place_id"]]["full_name"]
+            parsed_tweet["geo_name"] = cache.places[raw_tweet["geo"]["place_id"]]["name"]
+            parsed_tweet["geo_country"] = cache.places[raw_tweet["geo"]["place_id"]]["country"]
+            parsed_tweet["geo_country_code"] = cache.places[raw_tweet["geo"]["place_id"]]["country_code"]
+            parsed_tweet["geo_place_type"] = cache.places[raw_tweet["geo"]["place_id"]]["place_type"]
+            parsed_tweet["geo_json"] = cache.places[raw_tweet["geo"]["place_id"]]["geo_json"]
+        except:
+            pass
 
     # media, needs testing, only the first
-    if "attachments" in raw_tweet.keys():
+    if "attachments" in raw_tweet.keys() and "media" in steps:
         media_keys = []
         media_types = []
         media_urls = []
@@ -110,7 +599,7 @@ def parse_tweet(raw_tweet):
         media_widths = []
         media_alts = []
         for media_key in raw_tweet["attachments"]["media_keys"]:
-            media = media_dict[media_key]
+            media = cache.media[media_key]
             media_keys.append(media_key)
             media_types.append(media["media_type"])
             media_urls.append(media["media_url"])
@@ -128,355 +617,336 @@ def parse_tweet(raw_tweet):
         parsed_tweet["media_alt"] = json.dumps(media_alts)
 
     # BCP47 language tag
-    try:
-        parsed_tweet["lang"] = raw_tweet["lang"]
-    except:
-        pass
+    if "lang" in steps:
+        try:
+            parsed_tweet["lang"] = raw_tweet["lang"]
+        except:
+            pass
     
-    parsed_tweet["reply_settings"] = raw_tweet["reply_settings"]
-    try:
-        parsed_tweet["source"] = raw_tweet["source"]
-    except:
-        parsed_tweet["source"] = ""
+    if "reply_settings" in steps:
+        parsed_tweet["reply_settings"] = raw_tweet["reply_settings"]
+    if "source" in steps:
+        try:
+            parsed_tweet["source"] = raw_tweet["source"]
+        except:
+            parsed_tweet["source"] = ""
 
-    parsed_tweet["retweet_count"] = raw_tweet["public_metrics"]["retweet_count"]
-    parsed_tweet["reply_count"] = raw_tweet["public_metrics"]["reply_count"]
-    parsed_tweet["like_count"] = raw_tweet["public_metrics"]["like_count"]
-    parsed_tweet["quote_count"] = raw_tweet["public_metrics"]["quote_count"]
+    if "public_metrics" in steps:
+        parsed_tweet["retweet_count"] = raw_tweet["public_metrics"]["retweet_count"]
+        parsed_tweet["reply_count"] = raw_tweet["public_metrics"]["reply_count"]
+        parsed_tweet["like_count"] = raw_tweet["public_metrics"]["like_count"]
+        parsed_tweet["quote_count"] = raw_tweet["public_metrics"]["quote_count"]
 
-    if "referenced_tweets" in raw_tweet.keys():
+    if "referenced_tweets" in raw_tweet.keys() and "references" in steps:
         for referenced_tweet in raw_tweet["referenced_tweets"]:
-            if referenced_tweet["type"] == "quoted":
-                parsed_tweet["quoted_user_id"] = included_tweets_dict[referenced_tweet["id"]]["user_id"]
-                parsed_tweet["quoted_user_screen_name"] = included_tweets_dict[referenced_tweet["id"]]["screen_name"]
-                parsed_tweet["quoted_user_name"] = included_tweets_dict[referenced_tweet["id"]]["name"]
-                parsed_tweet["quoted_user_followers_count"] = included_tweets_dict[referenced_tweet["id"]]["followers_count"]
-                parsed_tweet["quoted_user_following_count"] = included_tweets_dict[referenced_tweet["id"]]["following_count"]
-                parsed_tweet["quoted_user_tweet_count"] = included_tweets_dict[referenced_tweet["id"]]["tweet_count"]
-                parsed_tweet["quoted_user_listed_count"] = included_tweets_dict[referenced_tweet["id"]]["listed_count"]
-                parsed_tweet["quoted_user_protected"] = included_tweets_dict[referenced_tweet["id"]]["protected"]
-                parsed_tweet["quoted_user_verified"] = included_tweets_dict[referenced_tweet["id"]]["verified"]
-                parsed_tweet["quoted_user_description"] = included_tweets_dict[referenced_tweet["id"]]["description"]
-                parsed_tweet["quoted_tweet_status_id"] = referenced_tweet["id"]
-                parsed_tweet["quoted_tweet_conversation_id"] = included_tweets_dict[referenced_tweet["id"]]["conversation_id"]
-                parsed_tweet["quoted_tweet_created_at"] = included_tweets_dict[referenced_tweet["id"]]["created_at"]
-                parsed_tweet["quoted_tweet_lang"] = included_tweets_dict[referenced_tweet["id"]]["lang"]
-                parsed_tweet["quoted_tweet_source"] = included_tweets_dict[referenced_tweet["id"]]["source"]
-                parsed_tweet["quoted_tweet_text"] = included_tweets_dict[referenced_tweet["id"]]["text"]
-                parsed_tweet["quoted_tweet_retweet_count"] = included_tweets_dict[referenced_tweet["id"]]["retweet_count"]
-                parsed_tweet["quoted_tweet_reply_count"] = included_tweets_dict[referenced_tweet["id"]]["reply_count"]
-                parsed_tweet["quoted_tweet_like_count"] = included_tweets_dict[referenced_tweet["id"]]["like_count"]
-                parsed_tweet["quoted_tweet_quote_count"] = included_tweets_dict[referenced_tweet["id"]]["quote_count"]
-            elif referenced_tweet["type"] == "retweeted":
-                parsed_tweet["retweeted_user_id"] = included_tweets_dict[referenced_tweet["id"]]["user_id"]
-                parsed_tweet["retweeted_user_screen_name"] = included_tweets_dict[referenced_tweet["id"]]["screen_name"]
-                parsed_tweet["retweeted_user_name"] = included_tweets_dict[referenced_tweet["id"]]["name"]
-                parsed_tweet["retweeted_user_followers_count"] = included_tweets_dict[referenced_tweet["id"]]["followers_count"]
-                parsed_tweet["retweeted_user_following_count"] = included_tweets_dict[referenced_tweet["id"]]["following_count"]
-                parsed_tweet["retweeted_user_tweet_count"] = included_tweets_dict[referenced_tweet["id"]]["tweet_count"]
-                parsed_tweet["retweeted_user_listed_count"] = included_tweets_dict[referenced_tweet["id"]]["listed_count"]
-                parsed_tweet["retweeted_user_protected"] = included_tweets_dict[referenced_tweet["id"]]["protected"]
-                parsed_tweet["retweeted_user_verified"] = included_tweets_dict[referenced_tweet["id"]]["verified"]
-                parsed_tweet["retweeted_user_description"] = included_tweets_dict[referenced_tweet["id"]]["description"]
-                parsed_tweet["retweeted_tweet_status_id"] = referenced_tweet["id"]
-                parsed_tweet["retweeted_tweet_conversation_id"] = included_tweets_dict[referenced_tweet["id"]]["conversation_id"]
-                parsed_tweet["retweeted_tweet_created_at"] = included_tweets_dict[referenced_tweet["id"]]["created_at"]
-                parsed_tweet["retweeted_tweet_lang"] = included_tweets_dict[referenced_tweet["id"]]["lang"]
-                parsed_tweet["retweeted_tweet_source"] = included_tweets_dict[referenced_tweet["id"]]["source"]
-                parsed_tweet["retweeted_tweet_text"] = included_tweets_dict[referenced_tweet["id"]]["text"]
-                parsed_tweet["retweeted_tweet_retweet_count"] = included_tweets_dict[referenced_tweet["id"]]["retweet_count"]
-                parsed_tweet["retweeted_tweet_reply_count"] = included_tweets_dict[referenced_tweet["id"]]["reply_count"]
-                parsed_tweet["retweeted_tweet_like_count"] = included_tweets_dict[referenced_tweet["id"]]["like_count"]
-                parsed_tweet["retweeted_tweet_quote_count"] = included_tweets_dict[referenced_tweet["id"]]["quote_count"]
-                
-            elif referenced_tweet["type"] == "replied_to":
-                try:
-                    parsed_tweet["replied_user_id"] = included_tweets_dict[referenced_tweet["id"]]["user_id"]
-                    parsed_tweet["replied_user_screen_name"] = included_tweets_dict[referenced_tweet["id"]]["screen_name"]
-                    parsed_tweet["replied_user_name"] = included_tweets_dict[referenced_tweet["id"]]["name"]
-                    parsed_tweet["replied_user_followers_count"] = included_tweets_dict[referenced_tweet["id"]]["followers_count"]
-                    parsed_tweet["replied_user_following_count"] = included_tweets_dict[referenced_tweet["id"]]["following_count"]
-                    parsed_tweet["replied_user_tweet_count"] = included_tweets_dict[referenced_tweet["id"]]["tweet_count"]
-                    parsed_tweet["replied_user_listed_count"] = included_tweets_dict[referenced_tweet["id"]]["listed_count"]
-                    parsed_tweet["replied_user_protected"] = included_tweets_dict[referenced_tweet["id"]]["protected"]
-                    parsed_tweet["replied_user_verified"] = included_tweets_dict[referenced_tweet["id"]]["verified"]
-                    parsed_tweet["replied_user_description"] = included_tweets_dict[referenced_tweet["id"]]["description"]
-                    parsed_tweet["replied_tweet_status_id"] = referenced_tweet["id"]
-                    parsed_tweet["replied_tweet_conversation_id"] = included_tweets_dict[referenced_tweet["id"]]["conversation_id"]
-                    parsed_tweet["replied_tweet_created_at"] = included_tweets_dict[referenced_tweet["id"]]["created_at"]
-                    parsed_tweet["replied_tweet_lang"] = included_tweets_dict[referenced_tweet["id"]]["lang"]
-                    parsed_tweet["replied_tweet_source"] = included_tweets_dict[referenced_tweet["id"]]["source"]
-                    parsed_tweet["replied_tweet_text"] = included_tweets_dict[referenced_tweet["id"]]["text"]
-                    parsed_tweet["replied_tweet_retweet_count"] = included_tweets_dict[referenced_tweet["id"]]["retweet_count"]
-                    parsed_tweet["replied_tweet_reply_count"] = included_tweets_dict[referenced_tweet["id"]]["reply_count"]
-                    parsed_tweet["replied_tweet_like_count"] = included_tweets_dict[referenced_tweet["id"]]["like_count"]
-                    parsed_tweet["replied_tweet_quote_count"] = included_tweets_dict[referenced_tweet["id"]]["quote_count"]
-                except:
+            if not referenced_tweet["type"] in reference_columns:
+                continue
+            status_id_column, columns = reference_columns[referenced_tweet["type"]]
+            # looked up whether or not its columns are selected, so the status id and the is_*
+            # flags don't depend on the selection
+            try:
+                included_tweet = cache.tweets[referenced_tweet["id"]]
+            except KeyError:
+                # deleted or protected parent, not counted as a reply
+                if referenced_tweet["type"] != "replied_to":
+                    raise
+                if "replied_to" in steps:
                     parsed_tweet["replied_user_id"] = raw_tweet["in_reply_to_user_id"]
-                
+                continue
+            if referenced_tweet["type"] in steps:
+                # one lookup of the included tweet, all of its columns copied in one step
+                parsed_tweet.update(zip(columns, reference_getter(included_tweet)))
+            parsed_tweet[status_id_column] = referenced_tweet["id"]
+
     # user fields
-    parsed_tweet["user_id"] = raw_tweet["author_id"]
-    parsed_tweet["screen_name"] = user_dict[raw_tweet["author_id"]]["username"]
-    parsed_tweet["name"] = user_dict[raw_tweet["author_id"]]["name"]
-    parsed_tweet["account_created_at"] = user_dict[raw_tweet["author_id"]]["created_at"]
-    parsed_tweet["description"] = user_dict[raw_tweet["author_id"]]["description"]
-    parsed_tweet["url"] = user_dict[raw_tweet["author_id"]]["url"]
-    parsed_tweet["location"] = user_dict[raw_tweet["author_id"]]["location"]
-    parsed_tweet["followers_count"] = user_dict[raw_tweet["author_id"]]["followers_count"]
-    parsed_tweet["following_count"] = user_dict[raw_tweet["author_id"]]["following_count"]
-    parsed_tweet["tweet_count"] = user_dict[raw_tweet["author_id"]]["tweet_count"]
-    parsed_tweet["listed_count"] = user_dict[raw_tweet["author_id"]]["listed_count"]
-    parsed_tweet["protected"] = user_dict[raw_tweet["author_id"]]["protected"]
-    parsed_tweet["verified"] = user_dict[raw_tweet["author_id"]]["verified"]
-
-    parsed_tweet["is_retweet"] = "False" if parsed_tweet["retweeted_tweet_status_id"] == "" else "True"
-    parsed_tweet["is_reply"] = "False" if parsed_tweet["replied_tweet_status_id"] == "" else "True"
-    parsed_tweet["is_quote"] = "False" if parsed_tweet["quoted_tweet_status_id"] == "" else "True"
+    if "user" in steps:
+        parsed_tweet["user_id"] = raw_tweet["author_id"]
+        parsed_tweet["screen_name"] = cache.users[raw_tweet["author_id"]]["username"]
+        parsed_tweet["name"] = cache.users[raw_tweet["author_id"]]["name"]
+        parsed_tweet["account_created_at"] = cache.users[raw_tweet["author_id"]]["created_at"]
+        parsed_tweet["description"] = cache.users[raw_tweet["author_id"]]["description"]
+        parsed_tweet["url"] = cache.users[raw_tweet["author_id"]]["url"]
+        parsed_tweet["location"] = cache.users[raw_tweet["author_id"]]["location"]
+        parsed_tweet["followers_count"] = cache.users[raw_tweet["author_id"]]["followers_count"]
+        parsed_tweet["following_count"] = cache.users[raw_tweet["author_id"]]["following_count"]
+        parsed_tweet["tweet_count"] = cache.users[raw_tweet["author_id"]]["tweet_count"]
+        parsed_tweet["listed_count"] = cache.users[raw_tweet["author_id"]]["listed_count"]
+        parsed_tweet["protected"] = cache.users[raw_tweet["author_id"]]["protected"]
+        parsed_tweet["verified"] = cache.users[raw_tweet["author_id"]]["verified"]
+
+    if "references" in steps:
+        parsed_tweet["is_retweet"] = "False" if parsed_tweet["retweeted_tweet_status_id"] == "" else "True"
+        parsed_tweet["is_reply"] = "False" if parsed_tweet["replied_tweet_status_id"] == "" else "True"
+        parsed_tweet["is_quote"] = "False" if parsed_tweet["quoted_tweet_status_id"] == "" else "True"
 
     parsed_tweet["queried_at"] = queried_at
 
-    return(parsed_tweet)
-
-def parse_tweets(r):
-    if "includes" in r.json().keys():
-        if "users" in r.json()["includes"].keys():
-            for user in r.json()["includes"]["users"]:
-                if not user["id"] in user_dict.keys():
-                    user_dict[user["id"]] = {}
-                    try:
-                        user_dict[user["id"]]["name"] = user["name"]
-                    except:
-                        user_dict[user["id"]]["name"] = ""
-
-                    try:
-                        user_dict[user["id"]]["username"] = user["username"]
-                    except:
-                        user_dict[user["id"]]["username"] = ""
-
-                    try:
-                        user_dict[user["id"]]["created_at"] = user["created_at"]
-                    except:
-                        user_dict[user["id"]]["created_at"] = ""
-
-                    try:
-                        user_dict[user["id"]]["description"] = user["description"]
-                    except:
-                        user_dict[user["id"]]["description"] = ""
-
-                    try:
-                        user_dict[user["id"]]["url"] = user["entities"]["url"]["urls"][0]["expanded_url"]
-                    except:
-                        try:
-                            user_dict[user["id"]]["url"] = user["url"]
-                        except:
-                            user_dict[user["id"]]["url"] = ""
-
-                    try:
-                        user_dict[user["id"]]["location"] = user["location"]
-                    except:
-                        user_dict[user["id"]]["location"] = ""
-
-                    try:
-                        user_dict[user["id"]]["followers_count"] = user["public_metrics"]["followers_count"]
-                    except:
-                        user_dict[user["id"]]["followers_count"] = ""
-
-                    try:
-                        user_dict[user["id"]]["following_count"] = user["public_metrics"]["following_count"]
-                    except:
-                        user_dict[user["id"]]["following_count"] = ""
-
-                    try:
-                        user_dict[user["id"]]["tweet_count"] = user["public_metrics"]["tweet_count"]
-                    except:
-                        user_dict[user["id"]]["tweet_count"] = ""
-
-                    try:
-                        user_dict[user["id"]]["listed_count"] = user["public_metrics"]["listed_count"]
-                    except:
-                        user_dict[user["id"]]["listed_count"] = ""
-
-                    try:
-                        user_dict[user["id"]]["protected"] = user["protected"]
-                    except:
-                        user_dict[user["id"]]["protected"] = ""
-
-                    try:
-                        user_dict[user["id"]]["verified"] = user["verified"]
-                    except:
-                        user_dict[user["id"]]["verified"] = ""
-
-        if "tweets" in r.json()["includes"].keys():
-            for tweet in r.json()["includes"]["tweets"]:
-                if not tweet["id"] in included_tweets_dict.keys():
-                    included_tweets_dict[tweet["id"]] = {}
+    # only keys of the template are set, so the values are in key_names order
+    if len(parsed_tweet) != len(key_names):
+        raise Exception(f"Unknown keys in parsed tweet: {set(parsed_tweet) - set(key_names)}")
+    return(TweetRecord(list(parsed_tweet.values())))
+
+def parse_tweets(page, cache=None, columns=None):
+    start = time.perf_counter()
+    if cache is None:
+        cache = entity_cache
+    columns = column_selection(columns)
+    if isinstance(page, requests.Response):
+        page = decode_response(page)
+
+    # windows fetched in parallel can share a cache, pages are parsed one at a time
+    with cache.lock:
+        if "includes" in page.keys():
+            if "users" in page["includes"].keys():
+                for user in page["includes"]["users"]:
+                    if not user["id"] in cache.users:
+                        cache.users[user["id"]] = {}
+                        try:
+                            cache.users[user["id"]]["name"] = user["name"]
+                        except:
+                            cache.users[user["id"]]["name"] = ""
+
+                        try:
+                            cache.users[user["id"]]["username"] = user["username"]
+                        except:
+                            cache.users[user["id"]]["username"] = ""
+
+                        try:
+                            cache.users[user["id"]]["created_at"] = user["created_at"]
+                        except:
+                            cache.users[user["id"]]["created_at"] = ""
+
+                        try:
+                            cache.users[user["id"]]["description"] = user["description"]
+                        except:
+                            cache.users[user["id"]]["description"] = ""
+
+                        try:
+                            cache.users[user["id"]]["url"] = user["entities"]["url"]["urls"][0]["expanded_url"]
+                        except:
+                            try:
+                                cache.users[user["id"]]["url"] = user["url"]
+                            except:
+                                cache.users[user["id"]]["url"] = ""
+
+                        try:
+                            cache.users[user["id"]]["location"] = user["location"]
+                        except:
+                            cache.users[user["id"]]["location"] = ""
+
+                        try:
+                            cache.users[user["id"]]["followers_count"] = user["public_metrics"]["followers_count"]
+                        except:
+                            cache.users[user["id"]]["followers_count"] = ""
+
+                        try:
+                            cache.users[user["id"]]["following_count"] = user["public_metrics"]["following_count"]
+                        except:
+                            cache.users[user["id"]]["following_count"] = ""
+
+                        try:
+                            cache.users[user["id"]]["tweet_count"] = user["public_metrics"]["tweet_count"]
+                        except:
+                            cache.users[user["id"]]["tweet_count"] = ""
+
+                        try:
+                            cache.users[user["id"]]["listed_count"] = user["public_metrics"]["listed_count"]
+                        except:
+                            cache.users[user["id"]]["listed_count"] = ""
+
+                        try:
+                            cache.users[user["id"]]["protected"] = user["protected"]
+                        except:
+                            cache.users[user["id"]]["protected"] = ""
+
+                        try:
+                            cache.users[user["id"]]["verified"] = user["verified"]
+                        except:
+                            cache.users[user["id"]]["verified"] = ""
+
+            if "tweets" in page["includes"].keys():
+                for tweet in page["includes"]["tweets"]:
+                    if not tweet["id"] in cache.tweets:
+                        cache.tweets[tweet["id"]] = {}
                     
-                    try:
-                        included_tweets_dict[tweet["id"]]["conversation_id"] = tweet["conversation_id"]
-                    except:
-                        included_tweets_dict[tweet["id"]]["conversation_id"] = ""
-
-                    try:
-                        included_tweets_dict[tweet["id"]]["created_at"] = tweet["created_at"]
-                    except:
-                        included_tweets_dict[tweet["id"]]["created_at"] = ""
-
-                    try:
-                        included_tweets_dict[tweet["id"]]["lang"] = tweet["lang"]
-                    except:
-                        included_tweets_dict[tweet["id"]]["lang"] = ""
-
-                    try:
-                        included_tweets_dict[tweet["id"]]["source"] = tweet["source"]
-                    except:
-                        included_tweets_dict[tweet["id"]]["source"] = ""
-
-                    try:
-                        included_tweets_dict[tweet["id"]]["text"] = tweet["text"]
-                    except:
-                        included_tweets_dict[tweet["id"]]["text"] = ""
-
-                    try:
-                        included_tweets_dict[tweet["id"]]["retweet_count"] = tweet["public_metrics"]["retweet_count"]
-                    except:
-                        included_tweets_dict[tweet["id"]]["retweet_count"] = ""
-
-                    try:
-                        included_tweets_dict[tweet["id"]]["reply_count"] = tweet["public_metrics"]["reply_count"]
-                    except:
-                        included_tweets_dict[tweet["id"]]["reply_count"] = ""
-
-                    try:
-                        included_tweets_dict[tweet["id"]]["like_count"] = tweet["public_metrics"]["like_count"]
-                    except:
-                        included_tweets_dict[tweet["id"]]["like_count"] = ""
-
-                    try:
-                        included_tweets_dict[tweet["id"]]["quote_count"] = tweet["public_metrics"]["quote_count"]
-                    except:
-                        included_tweets_dict[tweet["id"]]["quote_count"] = ""
-
-                    try:
-                        included_tweets_dict[tweet["id"]]["user_id"] = tweet["author_id"]
-                    except:
-                        included_tweets_dict[tweet["id"]]["user_id"] = ""
-
-                    try:
-                        included_tweets_dict[tweet["id"]]["screen_name"] = user_dict[tweet["author_id"]]["username"]
-                    except:
-                        included_tweets_dict[tweet["id"]]["screen_name"] = ""
-
-                    try:
-                        included_tweets_dict[tweet["id"]]["name"] = user_dict[tweet["author_id"]]["name"]
-                    except:
-                        included_tweets_dict[tweet["id"]]["name"] = ""
-
-                    try:
-                        included_tweets_dict[tweet["id"]]["followers_count"] = user_dict[tweet["author_id"]]["followers_count"]
-                    except:
-                        included_tweets_dict[tweet["id"]]["followers_count"] = ""
-
-                    try:
-                        included_tweets_dict[tweet["id"]]["following_count"] = user_dict[tweet["author_id"]]["following_count"]
-                    except:
-                        included_tweets_dict[tweet["id"]]["following_count"] = ""
-
-                    try:
-                        included_tweets_dict[tweet["id"]]["tweet_count"] = user_dict[tweet["author_id"]]["tweet_count"]
-                    except:
-                        included_tweets_dict[tweet["id"]]["tweet_count"] = ""
-
-                    try:
-                        included_tweets_dict[tweet["id"]]["listed_count"] = user_dict[tweet["author_id"]]["listed_count"]
-                    except:
-                        included_tweets_dict[tweet["id"]]["listed_count"] = ""
-
-                    try:
-                        included_tweets_dict[tweet["id"]]["protected"] = user_dict[tweet["author_id"]]["protected"]
-                    except:
-                        included_tweets_dict[tweet["id"]]["protected"] = ""
-
-                    try:
-                        included_tweets_dict[tweet["id"]]["verified"] = user_dict[tweet["author_id"]]["verified"]
-                    except:
-                        included_tweets_dict[tweet["id"]]["verified"] = ""
-
-                    try:
-                        included_tweets_dict[tweet["id"]]["description"] = user_dict[tweet["author_id"]]["description"]
-                    except:
-                        included_tweets_dict[tweet["id"]]["description"] = ""
-
-
-        if "places" in r.json()["includes"].keys():
-            for place in r.json()["includes"]["places"]:
-                if not place["id"] in places_dict.keys():
-                    places_dict[place["id"]] = {}
-                    try:
-                        places_dict[place["id"]]["full_name"] = place["full_name"]
-                    except:
-                        places_dict[place["id"]]["full_name"] = ""
+                        try:
+                            cache.tweets[tweet["id"]]["conversation_id"] = tweet["conversation_id"]
+                        except:
+                            cache.tweets[tweet["id"]]["conversation_id"] = ""
+
+                        try:
+                            cache.tweets[tweet["id"]]["created_at"] = tweet["created_at"]
+                        except:
+                            cache.tweets[tweet["id"]]["created_at"] = ""
+
+                        try:
+                            cache.tweets[tweet["id"]]["lang"] = tweet["lang"]
+                        except:
+                            cache.tweets[tweet["id"]]["lang"] = ""
+
+                        try:
+                            cache.tweets[tweet["id"]]["source"] = tweet["source"]
+                        except:
+                            cache.tweets[tweet["id"]]["source"] = ""
+
+                        try:
+                            cache.tweets[tweet["id"]]["text"] = tweet["text"]
+                        except:
+                            cache.tweets[tweet["id"]]["text"] = ""
+
+                        try:
+                            cache.tweets[tweet["id"]]["retweet_count"] = tweet["public_metrics"]["retweet_count"]
+                        except:
+                            cache.tweets[tweet["id"]]["retweet_count"] = ""
+
+                        try:
+                            cache.tweets[tweet["id"]]["reply_count"] = tweet["public_metrics"]["reply_count"]
+                        except:
+                            cache.tweets[tweet["id"]]["reply_count"] = ""
+
+                        try:
+                            cache.tweets[tweet["id"]]["like_count"] = tweet["public_metrics"]["like_count"]
+                        except:
+                            cache.tweets[tweet["id"]]["like_count"] = ""
+
+                        try:
+                            cache.tweets[tweet["id"]]["quote_count"] = tweet["public_metrics"]["quote_count"]
+                        except:
+                            cache.tweets[tweet["id"]]["quote_count"] = ""
+
+                        try:
+                            cache.tweets[tweet["id"]]["user_id"] = tweet["author_id"]
+                        except:
+                            cache.tweets[tweet["id"]]["user_id"] = ""
+
+                        try:
+                            cache.tweets[tweet["id"]]["screen_name"] = cache.users[tweet["author_id"]]["username"]
+                        except:
+                            cache.tweets[tweet["id"]]["screen_name"] = ""
+
+                        try:
+                            cache.tweets[tweet["id"]]["name"] = cache.users[tweet["author_id"]]["name"]
+                        except:
+                            cache.tweets[tweet["id"]]["name"] = ""
+
+                        try:
+                            cache.tweets[tweet["id"]]["followers_count"] = cache.users[tweet["author_id"]]["followers_count"]
+                        except:
+                            cache.tweets[tweet["id"]]["followers_count"] = ""
+
+                        try:
+                            cache.tweets[tweet["id"]]["following_count"] = cache.users[tweet["author_id"]]["following_count"]
+                        except:
+                            cache.tweets[tweet["id"]]["following_count"] = ""
+
+                        try:
+                            cache.tweets[tweet["id"]]["tweet_count"] = cache.users[tweet["author_id"]]["tweet_count"]
+                        except:
+                            cache.tweets[tweet["id"]]["tweet_count"] = ""
+
+                        try:
+                            cache.tweets[tweet["id"]]["listed_count"] = cache.users[tweet["author_id"]]["listed_count"]
+                        except:
+                            cache.tweets[tweet["id"]]["listed_count"] = ""
+
+                        try:
+                            cache.tweets[tweet["id"]]["protected"] = cache.users[tweet["author_id"]]["protected"]
+                        except:
+                            cache.tweets[tweet["id"]]["protected"] = ""
+
+                        try:
+                            cache.tweets[tweet["id"]]["verified"] = cache.users[tweet["author_id"]]["verified"]
+                        except:
+                            cache.tweets[tweet["id"]]["verified"] = ""
+
+                        try:
+                            cache.tweets[tweet["id"]]["description"] = cache.users[tweet["author_id"]]["description"]
+                        except:
+                            cache.tweets[tweet["id"]]["description"] = ""
+
+
+            if "places" in page["includes"].keys():
+                for place in page["includes"]["places"]:
+                    if not place["id"] in cache.places:
+                        cache.places[place["id"]] = {}
+                        try:
+                            cache.places[place["id"]]["full_name"] = place["full_name"]
+                        except:
+                            cache.places[place["id"]]["full_name"] = ""
                     
-                    try:
-                        places_dict[place["id"]]["name"] = place["name"]
-                    except:
-                        places_dict[place["id"]]["name"] = ""
+                        try:
+                            cache.places[place["id"]]["name"] = place["name"]
+                        except:
+                            cache.places[place["id"]]["name"] = ""
                     
-                    try:
-                        places_dict[place["id"]]["country"] = place["country_code"]
-                    except:
-                        places_dict[place["id"]]["country"] = ""
+                        try:
+                            cache.places[place["id"]]["country"] = place["country"]
+                        except:
+                            cache.places[place["id"]]["country"] = ""
+
+                        try:
+                            cache.places[place["id"]]["country_code"] = place["country_code"]
+                        except:
+                            cache.places[place["id"]]["country_code"] = ""
                     
-                    try:
-                        places_dict[place["id"]]["place_type"] = place["place_type"]
-                    except:
-                        places_dict[place["id"]]["place_type"] = ""
+                        try:
+                            cache.places[place["id"]]["place_type"] = place["place_type"]
+                        except:
+                            cache.places[place["id"]]["place_type"] = ""
                     
-                    try:
-                        places_dict[place["id"]]["geo_json"] = json.dumps(place["geo"])
-                    except:
-                        places_dict[place["id"]]["geo_json"] = ""
-
-        if "media" in r.json()["includes"].keys():
-            for media in r.json()["includes"]["media"]:
-                if not media["media_key"] in media_dict.keys():
-                    media_dict[media["media_key"]] = {}
-
-                    try:
-                        media_dict[media["media_key"]]["media_type"] = media["type"]
-                    except:
-                        media_dict[media["media_key"]]["media_type"] = ""
-
-                    try:
-                        media_dict[media["media_key"]]["media_url"] = media["url"]
-                    except:
-                        media_dict[media["media_key"]]["media_url"] = ""
-
-                    try:
-                        media_dict[media["media_key"]]["media_duration"] = media["duration_ms"]
-                    except:
-                        media_dict[media["media_key"]]["media_duration"] = ""
-
-                    try:
-                        media_dict[media["media_key"]]["media_height"] = media["height"]
-                    except:
-                        media_dict[media["media_key"]]["media_height"] = ""
-
-                    try:
-                        media_dict[media["media_key"]]["media_width"] = media["width"]
-                    except:
-                        media_dict[media["media_key"]]["media_width"] = ""
-
-                    try:
-                        media_dict[media["media_key"]]["media_alt"] = media["alt_text"]
-                    except:
-                        media_dict[media["media_key"]]["media_alt"] = ""
+                        try:
+                            cache.places[place["id"]]["geo_json"] = json.dumps(place["geo"])
+                        except:
+                            cache.places[place["id"]]["geo_json"] = ""
+
+            if "media" in page["includes"].keys():
+                for media in page["includes"]["media"]:
+                    if not media["media_key"] in cache.media:
+                        cache.media[media["media_key"]] = {}
+
+                        try:
+                            cache.media[media["media_key"]]["media_type"] = media["type"]
+                        except:
+                            cache.media[media["media_key"]]["media_type"] = ""
+
+                        try:
+                            cache.media[media["media_key"]]["media_url"] = media["url"]
+                        except:
+                            try:
+                                # videos and gifs have no url, only variants, the mp4 with the highest bitrate is used
+                                mp4_variants = [v for v in media["variants"] if v["content_type"] == "video/mp4"]
+                                cache.media[media["media_key"]]["media_url"] = max(mp4_variants, key=lambda v: v.get("bit_rate", 0))["url"]
+                            except:
+                                cache.media[media["media_key"]]["media_url"] = ""
+
+                        try:
+                            cache.media[media["media_key"]]["media_duration"] = media["duration_ms"]
+                        except:
+                            cache.media[media["media_key"]]["media_duration"] = ""
+
+                        try:
+                            cache.media[media["media_key"]]["media_height"] = media["height"]
+                        except:
+                            cache.media[media["media_key"]]["media_height"] = ""
+
+                        try:
+                            cache.media[media["media_key"]]["media_width"] = media["width"]
+                        except:
+                            cache.media[media["media_key"]]["media_width"] = ""
+
+                        try:
+                            cache.media[media["media_key"]]["media_alt"] = media["alt_text"]
+                        except:
+                            cache.media[media["media_key"]]["media_alt"] = ""
                     
                     
 
-    parsed_tweets = []
-    for tweet in r.json()["data"]:
-        parsed_tweets.append(parse_tweet(tweet))
+        parsed_tweets = []
+        for tweet in page["data"]:
+            parsed_tweets.append(parse_tweet(tweet, cache, columns))
 
+    metrics.observe("parse_seconds", time.perf_counter() - start)
+    metrics.inc("tweets_parsed_total", len(parsed_tweets))
     return(parsed_tweets)
 
 def parse_user(raw_user):
@@ -522,7 +992,7 @@ def parse_user(raw_user):
     try:
         parsed_user["description"] = raw_user["description"]
     except:
-        user_dict[user["id"]]["description"] = ""
+        parsed_user["description"] = ""
 
     try:
         parsed_user["url"] = raw_user["entities"]["url"]["urls"][0]["expanded_url"]
@@ -583,14 +1053,18 @@ def parse_user(raw_user):
 
     return(parsed_user)
 
-def parse_users(r):
+def parse_users(page):
+    if isinstance(page, requests.Response):
+        page = decode_response(page)
+
+    # a page of names that were all not found has only errors
     parsed_users = []
-    for user in r.json()["data"]:
+    for user in page.get("data", []):
         parsed_users.append(parse_user(user))
 
     return(parsed_users)
 
-def lookup_tweets(tweet_ids, bearer_token, verbose=True):
+def lookup_tweets(tweet_ids, bearer_token, verbose=True, cache=None, columns=None):
     if verbose and logger.level >= 20:
         logger.setLevel(logging.INFO)
     
@@ -601,38 +1075,30 @@ def lookup_tweets(tweet_ids, bearer_token, verbose=True):
     query_ids = tweet_ids
     if len(query_ids) > 100:
         raise Exception("Query too long, halting")
+    columns = column_selection(columns)
     params = (
         ("ids", ",".join(query_ids)),
-        ("tweet.fields", "author_id,created_at,conversation_id,text,lang,geo,entities,reply_settings,public_metrics,source,referenced_tweets"),
-        ("user.fields", "id,name,username,created_at,description,url,location,protected,verified,public_metrics,entities"),
-        ("media.fields", "media_key,type,url,duration_ms,height,width,alt_text"),
-        ("expansions", "referenced_tweets.id,referenced_tweets.id.author_id,in_reply_to_user_id,author_id,attachments.media_keys,entities.mentions.username,geo.place_id")
-    )
+    ) + (tweet_params if columns is None else columns.params)
     
     logger.info(f"Searching for tweets with the following parameters (ids: {','.join(query_ids)})")
 
     try:
-        r = request_session.get("https://api.twitter.com/2/tweets", headers=headers, params=params)
+        r = rate_limits.request("tweets", f"{api_url}/tweets", headers=headers, params=params)
     except Exception as e:
         logger.error(f"Error getting tweets (Error: {e})")
-        
-    if (r.status_code == 429):
-        sleep_time = math.ceil((datetime.datetime.fromtimestamp(int(r.headers["x-rate-limit-reset"])) - datetime.datetime.today()).total_seconds()) + 15
-        if sleep_time < 1:
-            sleep_time = 900
-        logger.warning(f"Rate limit exceeded, resuming in {str(sleep_time)} seconds")
-        time.sleep(sleep_time)
-        r = request_session.get("https://api.twitter.com/2/tweets", headers=headers, params=params)
 
     if (r.status_code != 200):
         logger.error(f"Error getting tweets (status code: {r.status_code}), halting")
         exit()
 
-    if "errors" in r.json().keys():
+    page = decode_response(r)
+    if not "data" in page.keys():
         logger.warning(f"No tweets found")
         return(None)
+    if "errors" in page.keys():
+        logger.info(f"{len(page['errors'])} of {len(query_ids)} tweets not found")
 
-    queried_tweets = parse_tweets(r)
+    queried_tweets = parse_tweets(page, cache, columns)
     logger.info(f"Retrieved {len(queried_tweets)} tweets ({get_datetime_range(queried_tweets)})")
     logger.info(f"{r.headers['x-rate-limit-remaining']} of {r.headers['x-rate-limit-limit']} calls remaining.")
     return(queried_tweets)
@@ -648,34 +1114,28 @@ def lookup_users(user_names, bearer_token, verbose=True):
         raise Exception("Query too long, halting")
     params = (
         ("usernames", ",".join(user_names)),
-        ("user.fields", "id,name,username,created_at,description,url,location,protected,verified,public_metrics,entities,pinned_tweet_id,withheld")
-    )
+    ) + user_params
     logger.info(f"Looking up users with the following names: {','.join(user_names)}")
 
     try:
-        r = request_session.get("https://api.twitter.com/2/users/by", headers=headers, params=params)
+        r = rate_limits.request("users/by", f"{api_url}/users/by", headers=headers, params=params)
     except Exception as e:
         logger.error(f"Error getting tweets ({e}), halting")
         exit()
-        
-    if (r.status_code == 429):
-        sleep_time = math.ceil((datetime.datetime.fromtimestamp(int(r.headers["x-rate-limit-reset"])) - datetime.datetime.today()).total_seconds()) + 15
-        if sleep_time < 15:
-            sleep_time = 900
-        logger.warning(f"Rate limit exceeded, resuming in {str(sleep_time)} seconds")
-        time.sleep(sleep_time)
-        r = request_session.get("https://api.twitter.com/2/users/by", headers=headers, params=params)
 
     if (r.status_code != 200):
         logger.error(f"Error getting tweets (status code: {r.status_code}), halting")
         exit()
 
-    # if "errors" in r.json().keys():
-    #     print("WARNING (errors in response):")
-    #     for e in r.json()["errors"]:
-    #         print("\t", e["detail"])
+    page = decode_response(r)
+    if "errors" in page.keys():
+        # unknown or suspended names, the others are in data
+        for e in page["errors"]:
+            logger.warning(f"User not found ({e.get('detail', e)})")
 
-    queried_users = parse_users(r)
+    queried_users = parse_users(page)
+    if not queried_users:
+        logger.warning(f"No users found")
     logger.info(f"Retrieved {len(queried_users)} users")
     logger.info(f"{r.headers['x-rate-limit-remaining']} of {r.headers['x-rate-limit-limit']} calls remaining.")
     
@@ -683,54 +1143,129 @@ def lookup_users(user_names, bearer_token, verbose=True):
         logger.setLevel(logging.WARNING)
     return(queried_users)
 
-def lookup_retweet_users(tweet_id, bearer_token, verbose=True):
+def unique_batches(items, key=None, batch_size=100):
+    # de-duplicated items in input order, in lists of batch_size
+    seen = set()
+    batch = []
+    for item in items:
+        item_key = key(item) if key else item
+        if item_key in seen:
+            continue
+        seen.add(item_key)
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield(batch)
+            batch = []
+    if batch:
+        yield(batch)
+
+def lookup_tweets_bulk(tweet_ids, bearer_token, max_workers=4, verbose=False, cache=None, columns=None):
+    # any number of ids, looked up 100 at a time on a thread pool, yields parsed tweets in the order
+    # of tweet_ids (ids that were not found are skipped)
+    columns = column_selection(columns)
+    def lookup_batch(batch):
+        return(lookup_tweets(batch, bearer_token, verbose=verbose, cache=cache, columns=columns) or [])
+
+    for batch, queried_tweets in ordered_map(lookup_batch, unique_batches(str(i) for i in tweet_ids), max_workers=max_workers):
+        by_id = {t["status_id"]: t for t in queried_tweets}
+        for tweet_id in batch:
+            if tweet_id in by_id:
+                yield(by_id[tweet_id])
+
+user_name_pattern = re.compile(r"^[A-Za-z0-9_]{1,15}$")
+
+def valid_user_names(user_names):
+    # names the API accepts, one malformed name fails its whole batch with 400
+    for user_name in user_names:
+        if user_name_pattern.match(user_name):
+            yield(user_name)
+        else:
+            logger.warning(f"Invalid user name {user_name!r}, skipping")
+
+def lookup_users_bulk(user_names, bearer_token, max_workers=4, verbose=False):
+    # any number of user names, looked up 100 at a time on a thread pool, yields parsed users in the
+    # order of user_names (names that were not found are skipped). A batch that fails is logged and
+    # skipped instead of halting the others.
+    def lookup_batch(batch):
+        try:
+            return(lookup_users(batch, bearer_token, verbose=verbose) or [])
+        except (Exception, SystemExit) as e:
+            logger.error(f"Error looking up users {','.join(batch)} ({e!r}), skipping")
+            return([])
+
+    for batch, queried_users in ordered_map(lookup_batch, unique_batches(valid_user_names(user_names), key=str.lower), max_workers=max_workers):
+        by_name = {u["screen_name"].lower(): u for u in queried_users}
+        for user_name in batch:
+            if user_name.lower() in by_name:
+                yield(by_name[user_name.lower()])
+
+def iter_retweet_users(tweet_id, bearer_token, verbose=False):
+    # yields the users that retweeted tweet_id page by page, following next_token. Every user
+    # carries the id of the tweet in retweeted_status_id
     if verbose and logger.level >= 20:
         logger.setLevel(logging.INFO)
 
     headers = {
         "Authorization": "Bearer {}".format(bearer_token),
     }
-    if isinstance(tweet_id, str):
-        raise Exception("tweet_id must be a single string, halting")
-    
-    params = (
-        ("user.fields", "id,name,username,created_at,description,url,location,protected,verified,public_metrics,entities,pinned_tweet_id,withheld"),
-    )
-    logger.info(f"Getting users that retweeted the following tweet: {tweet_id}")
+    if not isinstance(tweet_id, (str, int)):
+        raise Exception("tweet_id must be a single id, halting")
+    tweet_id = str(tweet_id)
 
-    try:
-        r = request_session.get(f"https://api.twitter.com/2/tweets/{tweet_id}/retweeted_by", headers=headers, params=params)
-    except Exception as e:
-        logger.error(f"Error getting tweets ({e}), halting")
-        exit()
-        
-    if (r.status_code == 429):
-        sleep_time = math.ceil((datetime.datetime.fromtimestamp(int(r.headers["x-rate-limit-reset"])) - datetime.datetime.today()).total_seconds()) + 15
-        if sleep_time < 15:
-            sleep_time = 900
-        logger.warning(f"Rate limit exceeded, resuming in {str(sleep_time)} seconds")
-        time.sleep(sleep_time)
-        r = request_session.get("https://api.twitter.com/2/users/by", headers=headers, params=params)
-
-    if (r.status_code != 200):
-        logger.error(f"Error getting tweets (status code: {r.status_code}), halting")
-        exit()
-
-    # if "errors" in r.json().keys():
-    #     print("WARNING (errors in response):")
-    #     for e in r.json()["errors"]:
-    #         print("\t", e["detail"])
+    params = user_params + (("max_results", 100),)
+    logger.info(f"Getting users that retweeted the following tweet: {tweet_id}")
 
-    queried_users = parse_users(r)
-    logger.info(f"Retrieved {len(queried_users)} users")
+    n_users = 0
+    next_token = None
+    while True:
+        try:
+            r = rate_limits.request("tweets/:id/retweeted_by", f"{api_url}/tweets/{tweet_id}/retweeted_by", headers=headers, params=params + (("pagination_token", next_token),) if next_token else params)
+        except Exception as e:
+            logger.error(f"Error getting users ({e}), halting")
+            exit()
+
+        if (r.status_code != 200):
+            logger.error(f"Error getting users (status code: {r.status_code}, {next_token=}), halting")
+            exit()
+
+        page = decode_response(r)
+        if "data" in page:
+            for parsed_user in parse_users(page):
+                parsed_user["retweeted_status_id"] = tweet_id
+                n_users += 1
+                yield(parsed_user)
+        next_token = page.get("meta", {}).get("next_token")
+        if not next_token:
+            break
+
+    logger.info(f"Retrieved {n_users} users")
     logger.info(f"{r.headers['x-rate-limit-remaining']} of {r.headers['x-rate-limit-limit']} calls remaining.")
-    
+
     if verbose and logger.level >= 20:
         logger.setLevel(logging.WARNING)
-    
-    return(queried_users)
 
-def search_tweets(query, bearer_token, since_id=None, until_id=None, start_time=None, end_time=None, mode="recent", verbose=False):
+def lookup_retweet_users(tweet_id, bearer_token, verbose=True):
+    return(list(iter_retweet_users(tweet_id, bearer_token, verbose=verbose)))
+
+def retweet_users_bulk(tweet_ids, bearer_token, max_workers=4, verbose=False):
+    # retweeters of any number of tweets, max_workers tweets at once. Yields users grouped by tweet in
+    # the order of tweet_ids, only the retweeters of max_workers tweets are held at a time
+    def retweet_users(tweet_id):
+        return(list(iter_retweet_users(tweet_id, bearer_token, verbose=verbose)))
+
+    for tweet_id, queried_users in ordered_map(retweet_users, dict.fromkeys(str(i) for i in tweet_ids), max_workers=max_workers):
+        for parsed_user in queried_users:
+            yield(parsed_user)
+
+def retweet_users_to_csv(tweet_ids, bearer_token, file_name, append=False, max_workers=4, verbose=False):
+    # retweet network as a users file with the retweeted tweet in the first column, returns the number of rows
+    return(users_to_csv(retweet_users_bulk(tweet_ids, bearer_token, max_workers=max_workers, verbose=verbose), file_name, append=append, verbose=verbose, columns=["retweeted_status_id"] + user_key_names))
+
+def iter_search_pages(query, bearer_token, since_id=None, until_id=None, start_time=None, end_time=None, mode="recent", verbose=False, pagination_token=None, strict=False, raw=False, archive=None, columns=None):
+    # yields decoded pages, or the undecoded response bodies with raw=True. Raw pages aren't
+    # decoded here, only their meta is read (the parsing processes of pages_to_csv decode them).
+    # Every page is also appended to the archive file if one is given. With columns, only their
+    # fields are requested.
     if verbose and logger.level >= 20:
         logger.setLevel(logging.INFO)
     
@@ -739,14 +1274,11 @@ def search_tweets(query, bearer_token, since_id=None, until_id=None, start_time=
     }
     if len(query) > 1024:
         raise Exception("Query too long, halting")
+    columns = column_selection(columns)
     params = (
         ("query", query),
         ("max_results", 500),
-        ("tweet.fields", "author_id,created_at,conversation_id,text,lang,geo,entities,reply_settings,public_metrics,source,referenced_tweets"),
-        ("user.fields", "id,name,username,created_at,description,url,location,protected,verified,public_metrics,entities"),
-        ("media.fields", "media_key,type,url,duration_ms,height,width,alt_text"),
-        ("expansions", "referenced_tweets.id,referenced_tweets.id.author_id,in_reply_to_user_id,author_id,attachments.media_keys,entities.mentions.username,geo.place_id")
-    )
+    ) + (tweet_params if columns is None else columns.params)
 
     logging_message = [f"{query=}"]
 
@@ -771,20 +1303,13 @@ def search_tweets(query, bearer_token, since_id=None, until_id=None, start_time=
 
     logger.info(f"Searching for tweets with the following parameters: {', '.join(logging_message)}")
 
+    # resume a search from the token of an earlier, interrupted run
+    first_params = params + (("pagination_token", pagination_token),) if pagination_token else params
+
     try:
-        r = request_session.get("https://api.twitter.com/2/tweets/search/{}".format(mode), headers=headers, params=params)
-        time.sleep(1) # only one request per second
+        r = rate_limits.request(f"tweets/search/{mode}", f"{api_url}/tweets/search/{mode}", headers=headers, params=first_params)
     except Exception as e:
         logger.error(f"Error getting tweets (Error: {e})")
-    
-    if (r.status_code == 429):
-        sleep_time = math.ceil((datetime.datetime.fromtimestamp(int(r.headers["x-rate-limit-reset"])) - datetime.datetime.today()).total_seconds()) + 15
-        if sleep_time < 15:
-            sleep_time = 900
-        logger.warning(f"Rate limit exceeded, resuming in {str(sleep_time)} seconds")
-        time.sleep(sleep_time)
-        r = request_session.get("https://api.twitter.com/2/tweets/search/{}".format(mode), headers=headers, params=params)
-        time.sleep(1) # only one request per second
 
     if (r.status_code != 200):
         if (r.status_code == 400):
@@ -793,91 +1318,418 @@ def search_tweets(query, bearer_token, since_id=None, until_id=None, start_time=
             logger.error(f"Error getting tweets (status code: {r.status_code}), halting")
         exit()
 
-    if r.json()["meta"]["result_count"] == 0:
+    page = {"meta": page_meta(r.content)} if raw else decode_response(r)
+    if page["meta"]["result_count"] == 0:
         logger.warning(f"No tweets found")
-        return(None)
-
-    searched_tweets = parse_tweets(r)
+    else:
+        if archive:
+            archive_page(r.content, archive)
+        yield(r.content if raw else page)
 
-    if "next_token" in r.json()["meta"]:
+    n_pages = 1
+    if "next_token" in page["meta"]:
         try:
-            loop_counter = 0
-            while "next_token" in r.json()["meta"]:
-                loop_counter += 1
-                logger.debug(f"Retrieved {len(searched_tweets)} tweets ({get_datetime_range(searched_tweets)})")
-                next_token = r.json()["meta"]["next_token"]
-                time.sleep(1.2)
-                r = request_session.get("https://api.twitter.com/2/tweets/search/{}".format(mode), headers=headers, params=params + (("pagination_token", next_token),))
-                time.sleep(1) # only one request per second
-
-                if (r.status_code == 429):
-                    sleep_time = math.ceil((datetime.datetime.fromtimestamp(int(r.headers["x-rate-limit-reset"])) - datetime.datetime.today()).total_seconds()) + 15
-                    if sleep_time < 15:
-                        sleep_time = 900
-                    logger.warning(f"Rate limit exceeded, resuming in {str(sleep_time)} seconds")
-                    time.sleep(sleep_time)
-                    r = request_session.get("https://api.twitter.com/2/tweets/search/{}".format(mode), headers=headers, params=params + (("pagination_token", next_token),))
-                    time.sleep(1) # only one request per second
-
-                if r.json()["meta"]["result_count"] > 0:
-                    searched_tweets.extend(parse_tweets(r))
+            while "next_token" in page["meta"]:
+                next_token = page["meta"]["next_token"]
+                r = rate_limits.request(f"tweets/search/{mode}", f"{api_url}/tweets/search/{mode}", headers=headers, params=params + (("pagination_token", next_token),))
+                if (r.status_code != 200):
+                    raise Exception(f"Error getting tweets (status code: {r.status_code}, {next_token=})")
+
+                page = {"meta": page_meta(r.content)} if raw else decode_response(r)
+                n_pages += 1
+                logger.debug(f"Retrieved page {n_pages} ({page['meta']['result_count']} tweets)")
+                if page["meta"]["result_count"] > 0:
+                    if archive:
+                        archive_page(r.content, archive)
+                    yield(r.content if raw else page)
         except Exception:
+            if strict:
+                raise
             logger.warning(f"Error in while loop results, continuing (Traceback: {traceback.format_exc()})")
-    
-    logger.info(f"Retrieved {len(searched_tweets)} tweets ({get_datetime_range(searched_tweets)})")
+
     logger.info(f"{r.headers['x-rate-limit-remaining']} of {r.headers['x-rate-limit-limit']} calls remaining.")
-    
+
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.WARNING)
+
+def iter_search_tweets(query, bearer_token, since_id=None, until_id=None, start_time=None, end_time=None, mode="recent", verbose=False, cache=None, archive=None, columns=None):
+    # yields parsed tweets page by page, nothing is kept after a page has been consumed
+    columns = column_selection(columns)
+    for page in iter_search_pages(query, bearer_token, since_id=since_id, until_id=until_id, start_time=start_time, end_time=end_time, mode=mode, verbose=verbose, archive=archive, columns=columns):
+        for parsed_tweet in parse_tweets(page, cache, columns):
+            yield(parsed_tweet)
+
+def search_tweets(query, bearer_token, since_id=None, until_id=None, start_time=None, end_time=None, mode="recent", verbose=False, cache=None, columns=None):
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.INFO)
+
+    searched_tweets = list(iter_search_tweets(query, bearer_token, since_id=since_id, until_id=until_id, start_time=start_time, end_time=end_time, mode=mode, cache=cache, columns=columns))
+
+    if searched_tweets:
+        logger.info(f"Retrieved {len(searched_tweets)} tweets ({get_datetime_range(searched_tweets)})")
+    else:
+        searched_tweets = None
+
     if verbose and logger.level >= 20:
         logger.setLevel(logging.WARNING)
     return(searched_tweets)
 
-def media_download(queried_tweets, base_path = ".", verbose=False):
+def ordered_map(function, items, max_workers=4, executor_class=ThreadPoolExecutor):
+    # runs function(item) on a thread (or process) pool and yields (item, result) in the order of items.
+    # Only max_workers items run ahead of the one being consumed, later results are not buffered.
+    items = iter(items)
+    with executor_class(max_workers=max_workers) as executor:
+        pending = collections.deque()
+        for item in itertools.islice(items, max_workers):
+            pending.append((item, executor.submit(function, item)))
+        while pending:
+            item, future = pending.popleft()
+            result = future.result()
+            for next_item in itertools.islice(items, 1):
+                pending.append((next_item, executor.submit(function, next_item)))
+            yield(item, result)
+
+def search_windows(query, bearer_token, windows, mode="all", max_workers=4, verbose=False, cache=None, columns=None):
+    # fetches several (start, end) datetime windows at once, yields (window, tweets) in the order of windows
+    columns = column_selection(columns)
+    def search_window(window):
+        from_date, to_date = window
+        return(list(iter_search_tweets(query, bearer_token, start_time=f"{from_date:%Y-%m-%dT%H:%M:%SZ}", end_time=f"{to_date:%Y-%m-%dT%H:%M:%SZ}", mode=mode, verbose=verbose, cache=cache, columns=columns)))
+
+    for window, tweets in ordered_map(search_window, windows, max_workers=max_workers):
+        yield(window, tweets)
+
+def search_counts(query, bearer_token, start_time=None, end_time=None, mode="all", granularity="day", verbose=False):
+    # returns [(start, end, tweet_count)] from the counts endpoint, or None if it can't be used.
+    # A counts page spans 31 days at day granularity and comes out of its own rate limit.
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.INFO)
+
+    headers = {
+        "Authorization": "Bearer {}".format(bearer_token),
+    }
+    params = (
+        ("query", query),
+        ("granularity", granularity)
+    )
+    if start_time:
+        params = params + (("start_time", start_time),)
+    if end_time:
+        params = params + (("end_time", end_time),)
+
+    counts = []
+    next_token = None
+    while True:
+        try:
+            r = rate_limits.request(f"tweets/counts/{mode}", f"{api_url}/tweets/counts/{mode}", headers=headers, params=params + (("next_token", next_token),) if next_token else params)
+        except Exception as e:
+            logger.warning(f"Error getting tweet counts ({e})")
+            return(None)
+        if (r.status_code != 200):
+            logger.warning(f"Error getting tweet counts (status code: {r.status_code})")
+            return(None)
+
+        page = decode_response(r)
+        for count in page.get("data", []):
+            counts.append((datetime.datetime.strptime(count["start"], "%Y-%m-%dT%H:%M:%S.000Z"), datetime.datetime.strptime(count["end"], "%Y-%m-%dT%H:%M:%S.000Z"), count["tweet_count"]))
+        next_token = page.get("meta", {}).get("next_token")
+        if not next_token:
+            break
+
+    logger.info(f"Counted {sum(count for _, _, count in counts)} tweets in {len(counts)} intervals")
+
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.WARNING)
+    return(sorted(counts))
+
+def plan_windows(query, bearer_token, start_date, end_date, mode="all", tweets_per_window=5000, max_workers=4, verbose=False):
+    # (start, end) windows of about the same number of tweets, from the counts endpoint: quiet
+    # stretches are merged into one window, empty ones skipped and busy days split into parts.
+    # Windows are at most tweets_per_window large, and small enough to keep max_workers busy.
+    # Returns None if the counts endpoint can't be used.
+    counts = search_counts(query, bearer_token, start_time=f"{start_date:%Y-%m-%dT%H:%M:%SZ}", end_time=f"{end_date:%Y-%m-%dT%H:%M:%SZ}", mode=mode, verbose=verbose)
+    if counts is None:
+        return(None)
+
+    n_total = sum(count for _, _, count in counts)
+    if n_total == 0:
+        # one (empty) request still creates the file
+        return([(start_date, end_date)])
+    target = min(tweets_per_window, max(500, math.ceil(n_total / max_workers)))
+
+    windows = []
+    window_start, window_end, n_window = None, None, 0
+    for from_date, to_date, count in counts:
+        if count == 0:
+            continue
+        if window_start is not None and n_window + count > target:
+            windows.append((window_start, window_end))
+            window_start, n_window = None, 0
+        if count > target:
+            n_parts = math.ceil(count / target)
+            step = datetime.timedelta(seconds=(to_date - from_date).total_seconds() // n_parts)
+            windows.extend((from_date + step * i, from_date + step * (i + 1) if i < n_parts - 1 else to_date) for i in range(n_parts))
+            continue
+        if window_start is None:
+            window_start = from_date
+        window_end = to_date
+        n_window += count
+    if window_start is not None:
+        windows.append((window_start, window_end))
+
+    logger.info(f"Planned {len(windows)} windows for {n_total} tweets")
+    return(windows)
+
+class Checkpoint:
+    # journal of a backfill: state of every window, the last pagination_token inside unfinished
+    # windows and the size of the output file after the last window that was written to it
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.lock = threading.Lock()
+        self.state = {"windows": {}, "file_size": None}
+        if os.path.isfile(file_name):
+            with open(file_name, "r") as f:
+                self.state = json.load(f)
+
+    def window(self, key):
+        with self.lock:
+            return(dict(self.state["windows"].get(key, {})))
+
+    def update(self, key, file_size=None, **values):
+        with self.lock:
+            self.state["windows"][key] = values
+            if file_size is not None:
+                self.state["file_size"] = file_size
+            self.save()
+
+    def plan(self, windows):
+        # the windows of the first run, so a resumed backfill fetches the same windows
+        with self.lock:
+            if not "plan" in self.state:
+                self.state["plan"] = [[f"{from_date:%Y-%m-%dT%H:%M:%SZ}", f"{to_date:%Y-%m-%dT%H:%M:%SZ}"] for from_date, to_date in windows]
+                self.save()
+            return([tuple(datetime.datetime.strptime(d, "%Y-%m-%dT%H:%M:%SZ") for d in window) for window in self.state["plan"]])
+
+    def columns(self, columns):
+        # the columns of the first run, journals written before column selection hold all of key_names
+        with self.lock:
+            if not "columns" in self.state:
+                self.state["columns"] = key_names if self.state["windows"] else columns
+                self.save()
+            return(self.state["columns"])
+
+    def file_size(self):
+        with self.lock:
+            return(self.state["file_size"])
+
+    def save(self):
+        # write and rename, a crash never leaves a half written journal
+        with open(f"{self.file_name}.tmp", "w") as f:
+            json.dump(self.state, f)
+        os.replace(f"{self.file_name}.tmp", self.file_name)
+
+    def remove(self):
+        if os.path.isfile(self.file_name):
+            os.remove(self.file_name)
+
+def has_checkpoint(file_name):
+    return(os.path.isfile(f"{file_name}.checkpoint.json"))
+
+def planned_windows(file_name):
+    # windows of an interrupted backfill, None if there is none or it predates stored plans
+    if not has_checkpoint(file_name):
+        return(None)
+    state = Checkpoint(f"{file_name}.checkpoint.json").state
+    if not "plan" in state:
+        return(None)
+    return([tuple(datetime.datetime.strptime(d, "%Y-%m-%dT%H:%M:%SZ") for d in window) for window in state["plan"]])
+
+def backfill_windows(query, bearer_token, windows, file_name, mode="all", max_workers=4, verbose=False, cache=None, archive_path=None, columns=None):
+    # like search_windows, but every page goes to a part file per window and is recorded in
+    # {file_name}.checkpoint.json, so a killed run continues at the last page it stored.
+    # With archive_path, the raw pages of every window are kept in {archive_path}/<window>.jsonl.gz
+    columns = column_selection(columns)
+    checkpoint = Checkpoint(f"{file_name}.checkpoint.json")
+    parts_path = f"{file_name}.parts"
+    os.makedirs(parts_path, exist_ok=True)
+    windows = checkpoint.plan(windows)
+    # part files have no header, a resumed run has to write the columns they were started with
+    if checkpoint.columns(tweet_header(columns)) != tweet_header(columns):
+        raise Exception(f"Columns differ from those of the interrupted backfill of {file_name}, halting")
+    check_csv_header(file_name, tweet_header(columns))
+
+    def window_key(window):
+        from_date, to_date = window
+        return(f"{from_date:%Y-%m-%dT%H:%M:%SZ}/{to_date:%Y-%m-%dT%H:%M:%SZ}")
+
+    def part_file(window):
+        from_date, to_date = window
+        return(f"{parts_path}/{from_date:%Y%m%d%H%M%S}-{to_date:%Y%m%d%H%M%S}.csv")
+
+    def fetch_window(window):
+        key = window_key(window)
+        entry = checkpoint.window(key)
+        if entry.get("status") in ("fetched", "written"):
+            return(entry["n_tweets"])
+        if entry.get("status") == "fetching" and not entry.get("next_token"):
+            checkpoint.update(key, status="fetched", n_tweets=entry["n_tweets"])
+            return(entry["n_tweets"])
+
+        # drop rows written after the last recorded page
+        with open(part_file(window), "a"):
+            pass
+        os.truncate(part_file(window), entry.get("part_size", 0))
+        n_tweets = entry.get("n_tweets", 0)
+
+        from_date, to_date = window
+        archive = f"{archive_path}/{from_date:%Y%m%d%H%M%S}-{to_date:%Y%m%d%H%M%S}.jsonl.gz" if archive_path else None
+        # and pages archived after it (or a half written gzip member), the page is fetched again
+        if archive and os.path.isfile(archive):
+            os.truncate(archive, entry.get("archive_size", 0))
+
+        pages = iter_search_pages(query, bearer_token, start_time=f"{from_date:%Y-%m-%dT%H:%M:%SZ}", end_time=f"{to_date:%Y-%m-%dT%H:%M:%SZ}", mode=mode, verbose=verbose, pagination_token=entry.get("next_token"), strict=True, archive=archive, columns=columns)
+        with open(part_file(window), "a", newline='') as f:
+            writer = csv.writer(f, dialect="unix")
+            for page in pages:
+                parsed_tweets = parse_tweets(page, cache, columns)
+                start = time.perf_counter()
+                for parsed_tweet in parsed_tweets:
+                    writer.writerow(tweet_row(parsed_tweet, columns))
+                f.flush()
+                metrics.inc("write_seconds_total", time.perf_counter() - start, sink="csv")
+                metrics.inc("tweets_written_total", len(parsed_tweets), sink="csv")
+                n_tweets += len(parsed_tweets)
+                checkpoint.update(key, status="fetching", next_token=page["meta"].get("next_token"), part_size=f.tell(), archive_size=os.path.getsize(archive) if archive else 0, n_tweets=n_tweets)
+
+        checkpoint.update(key, status="fetched", n_tweets=n_tweets)
+        return(n_tweets)
+
+    # drop rows appended after the last window that was recorded as written
+    file_size = checkpoint.file_size()
+    if file_size is not None and os.path.isfile(file_name) and os.path.getsize(file_name) > file_size:
+        os.truncate(file_name, file_size)
+
+    for window, n_tweets in ordered_map(fetch_window, windows, max_workers=max_workers):
+        key = window_key(window)
+        if checkpoint.window(key).get("status") != "written":
+            write_header = new_csv_file(file_name, True)
+            start = time.perf_counter()
+            # closed before its size is recorded, a compressed window ends on a complete member/frame
+            with open_csv(file_name, "a") as f:
+                if write_header:
+                    csv.writer(f, dialect="unix").writerow(tweet_header(columns))
+                with open(part_file(window), "r", newline='') as part:
+                    shutil.copyfileobj(part, f)
+            metrics.inc("write_seconds_total", time.perf_counter() - start, sink="merge")
+            checkpoint.update(key, file_size=os.path.getsize(file_name), status="written", n_tweets=n_tweets)
+        if os.path.isfile(part_file(window)):
+            os.remove(part_file(window))
+        yield(window, n_tweets)
+
+    checkpoint.remove()
+    shutil.rmtree(parts_path, ignore_errors=True)
+
+def manifest_keys(manifest_file):
+    # media_keys of finished downloads
+    if not os.path.isfile(manifest_file):
+        return(set())
+    with open(manifest_file, "r", newline='') as f:
+        return({row["media_key"] for row in csv.DictReader(f)})
+
+def add_to_manifest(manifest_file, media_key, media_type, media_url, file_name):
+    new_manifest = not os.path.isfile(manifest_file)
+    with open(manifest_file, "a", newline='') as f:
+        writer = csv.writer(f, dialect="unix")
+        if new_manifest:
+            writer.writerow(["media_key", "media_type", "media_url", "file_name", "size"])
+        writer.writerow([media_key, media_type, media_url, os.path.basename(file_name), os.path.getsize(file_name)])
+
+def collect_media(queried_tweets, media_types=("photo",), skip=()):
+    # media_key -> (media_type, media_url) of queried_tweets, each key once and without the keys in skip
+    media = {}
+    for t in (queried_tweets or []):
+        if t["media_url"] != "":
+            try:
+                media_keys = json.loads(t['media_key'])
+                media_urls = json.loads(t['media_url'])
+                tweet_media_types = json.loads(t['media_type'])
+            except:
+                continue
+
+            for media_key, media_url, media_type in zip(media_keys, media_urls, tweet_media_types):
+                if media_url == "" or media_key in skip or media_key in media:
+                    continue
+                if media_types is None or media_type in media_types:
+                    media[media_key] = (media_type, media_url)
+    return(media)
+
+def media_file(base_path, media_key, media_url):
+    _, file_extension = os.path.splitext(urllib.parse.urlsplit(media_url).path)
+    return(f"{base_path}/{media_key}{file_extension}")
+
+def media_download(queried_tweets, base_path = ".", media_types=("photo",), max_workers=8, verbose=False):
+    # downloads the media of queried_tweets on a thread pool. Every media_key is fetched once, bodies are
+    # streamed to a temporary file that is renamed when complete and {base_path}/manifest.csv lists
+    # finished downloads, which are skipped on the next call. media_types=None downloads every type.
     if verbose and logger.level >= 20:
         logger.setLevel(logging.INFO)
 
     if not os.path.exists(f"{base_path}"):
         logger.warning(f"base_path does not exist, creating {base_path}")
-        os.mkdir(f"{base_path}")
-
-    if queried_tweets:
-        for t in queried_tweets:
-            if t["media_url"] != "":
-                try:
-                    media_keys = json.loads(t['media_key'])
-                    media_urls = json.loads(t['media_url'])
-                    media_types = json.loads(t['media_type'])
-                except:
-                    pass
-                
-                for n, media_key in enumerate(media_keys):
-                    if media_types[n] == "photo":
-                        filename, file_extension = os.path.splitext(media_urls[n])
-                        filename = media_key
-                        if not os.path.exists(f"{base_path}/{filename}{file_extension}"):
-                            try:
-                                r = request_session.get(media_urls[n])
-                            except Exception as e:
-                                logger.error(f"Error downloading media for tweet (Error: {e})")
-
-                            if r.status_code != 200:
-                                logger.error(f"Error downloading media for tweet (Error: {e})")
-                            else:
-                                try:
-                                    with open(f"{base_path}/{filename}{file_extension}", "wb") as f:
-                                        f.write(r.content)
-                                except:
-                                    logger.error(f"Error downloading media for tweet (Error: {e})")   
-    else:
+        os.makedirs(f"{base_path}")
+
+    manifest_file = f"{base_path}/manifest.csv"
+    media = collect_media(queried_tweets, media_types, skip=manifest_keys(manifest_file))
+
+    if not queried_tweets:
         logger.warning(f"No tweets to download media")
+    elif not media:
+        logger.info(f"No new media to download")
+
+    manifest_lock = threading.Lock()
+
+    def download(media_key):
+        media_type, media_url = media[media_key]
+        file_name = media_file(base_path, media_key, media_url)
+        if not os.path.exists(file_name):
+            try:
+                start = time.perf_counter()
+                with request_session.get(media_url, stream=True) as r:
+                    if r.status_code != 200:
+                        logger.error(f"Error downloading media {media_key} (status code: {r.status_code})")
+                        return(False)
+                    with open(f"{file_name}.part", "wb") as f:
+                        for chunk in r.iter_content(chunk_size=65536):
+                            f.write(chunk)
+                os.replace(f"{file_name}.part", file_name)
+                metrics.observe("media_seconds", time.perf_counter() - start)
+                metrics.inc("media_bytes_total", os.path.getsize(file_name))
+            except Exception as e:
+                logger.error(f"Error downloading media {media_key} (Error: {e})")
+                if os.path.exists(f"{file_name}.part"):
+                    os.remove(f"{file_name}.part")
+                return(False)
+
+        with manifest_lock:
+            add_to_manifest(manifest_file, media_key, media_type, media_url, file_name)
+        return(True)
+
+    n_downloaded = 0
+    for media_key, success in ordered_map(download, list(media), max_workers=max_workers):
+        if success:
+            n_downloaded += 1
+    logger.info(f"Downloaded {n_downloaded} of {len(media)} media files")
 
     if verbose and logger.level >= 20:
         logger.setLevel(logging.WARNING)
+    return(n_downloaded)
 
-def tweets_to_csv(queried_tweets, file_name, append=False, verbose=False):
+def tweets_to_csv(queried_tweets, file_name, append=False, verbose=False, columns=None):
     if verbose and logger.level >= 20:
         logger.setLevel(logging.INFO)
-    
-    file_mode = "a+" if append else "w"
+
+    columns = column_selection(columns)
+    file_mode = "a" if append else "w"
     if append:
         logger.info(f"Appending to file {file_name}")
     else:
@@ -885,93 +1737,669 @@ def tweets_to_csv(queried_tweets, file_name, append=False, verbose=False):
         if os.path.isfile(file_name):
             logger.warning(f"Overwriting existing file ({file_name})")
 
-    if queried_tweets:
-        with open(file_name, file_mode, newline='') as f:
+    # queried_tweets may be a list or a generator (iter_search_tweets), rows are written as they arrive
+    queried_tweets = iter(queried_tweets or [])
+    first_tweet = next(queried_tweets, None)
+    n_written = 0
+    if first_tweet is not None:
+        write_header = new_csv_file(file_name, append)
+        if append:
+            check_csv_header(file_name, tweet_header(columns))
+        with open_csv(file_name, file_mode) as f:
             writer = csv.writer(f, dialect="unix")
-            if not append:
-                writer.writerow(key_names)
-            elif append and os.path.getsize(file_name) == 0:
-                writer.writerow(key_names)
-            for parsed_tweet in queried_tweets:
-                writer.writerow([parsed_tweet[k] for k in key_names])
+            if write_header:
+                writer.writerow(tweet_header(columns))
+            # only the time spent writing, not the time waiting for the next tweet
+            write_time = 0
+            for parsed_tweet in itertools.chain([first_tweet], queried_tweets):
+                start = time.perf_counter()
+                writer.writerow(tweet_row(parsed_tweet, columns))
+                write_time += time.perf_counter() - start
+                n_written += 1
+            metrics.inc("write_seconds_total", write_time, sink="csv")
+            metrics.inc("tweets_written_total", n_written, sink="csv")
     else:
         logger.warning(f"No tweets to write to file")
 
     if verbose and logger.level >= 20:
         logger.setLevel(logging.WARNING)
+    return(n_written)
+
+def tweet_column_types():
+    # column name -> "int", "timestamp", "bool", "list", "int_list" or "string"
+    column_types = {}
+    for key in key_names:
+        if key in ["created_at", "account_created_at", "queried_at"] or key.endswith("_tweet_created_at"):
+            column_types[key] = "timestamp"
+        elif key in ["hashtags", "mentions", "url_location", "url_unwound", "url_title", "url_description", "media_key", "media_type", "media_url", "media_alt"]:
+            column_types[key] = "list"
+        elif key in ["media_duration", "media_height", "media_width"]:
+            column_types[key] = "int_list"
+        elif key in ["status_id", "conversation_id", "user_id"] or key.endswith("_count") or key.endswith("_user_id") or key.endswith("_status_id") or key.endswith("_conversation_id"):
+            column_types[key] = "int"
+        elif key in ["url_sensitive", "protected", "verified"] or key.startswith("is_") or key.endswith("_protected") or key.endswith("_verified"):
+            column_types[key] = "bool"
+        else:
+            column_types[key] = "string"
+    return(column_types)
+
+def parquet_schema(columns=None):
+    arrow_types = {
+        "timestamp": pyarrow.timestamp("ms", tz="UTC"),
+        "list": pyarrow.list_(pyarrow.string()),
+        "int_list": pyarrow.list_(pyarrow.int64()),
+        "int": pyarrow.int64(),
+        "bool": pyarrow.bool_(),
+        "string": pyarrow.string()
+    }
+    column_types = tweet_column_types()
+    return(pyarrow.schema([(key, arrow_types[column_types[key]]) for key in tweet_header(columns)]))
+
+def to_parquet_value(value, column_type):
+    # parsed tweets hold "" for missing values and JSON strings for lists
+    if value == "" or value is None:
+        return(None)
+    if column_type == "int":
+        return(int(value))
+    if column_type == "timestamp":
+        if isinstance(value, int):
+            return(datetime.datetime.fromtimestamp(value, tz=datetime.timezone.utc))
+        return(datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=datetime.timezone.utc))
+    if column_type == "bool":
+        if isinstance(value, bool):
+            return(value)
+        return(value == "True")
+    if column_type == "list":
+        return(json.loads(value) if isinstance(value, str) else value)
+    if column_type == "int_list":
+        values = json.loads(value) if isinstance(value, str) else value
+        return([None if v == "" else int(v) for v in values])
+    return(str(value))
+
+def tweets_to_parquet(queried_tweets, file_name, append=False, batch_size=50000, verbose=False, columns=None):
+    # file_name is a directory of parquet files, every call adds one file so windows can be
+    # appended. Each file is written in row groups of batch_size tweets.
+    if pyarrow is None:
+        raise Exception("pyarrow is not installed, halting")
+
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.INFO)
 
-def users_to_csv(queried_users, file_name, append=False, verbose=False):
-    file_mode = "a+" if append else "w"
+    if append:
+        logger.info(f"Appending to dataset {file_name}")
+    else:
+        logger.info(f"Writing to dataset {file_name}")
+        if os.path.isdir(file_name) and os.listdir(file_name):
+            logger.warning(f"Overwriting existing dataset ({file_name})")
+            shutil.rmtree(file_name)
+    os.makedirs(file_name, exist_ok=True)
+
+    n_parts = len([p for p in os.listdir(file_name) if p.endswith(".parquet")])
+    part_file = f"{file_name}/part-{n_parts:05d}.parquet"
+    # files starting with _ are skipped by parquet readers
+    temp_file = f"{file_name}/_part-{n_parts:05d}.parquet.tmp"
+
+    columns = column_selection(columns)
+    schema = parquet_schema(columns)
+    column_types = tweet_column_types()
+    queried_tweets = iter(queried_tweets or [])
+    writer = None
+    n_written = 0
+    try:
+        while True:
+            batch = list(itertools.islice(queried_tweets, batch_size))
+            if not batch:
+                break
+            arrays = [pyarrow.array([to_parquet_value(parsed_tweet[key], column_types[key]) for parsed_tweet in batch], type=schema.field(n).type) for n, key in enumerate(schema.names)]
+            table = pyarrow.Table.from_arrays(arrays, schema=schema)
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(temp_file, schema)
+            start = time.perf_counter()
+            writer.write_table(table)
+            metrics.inc("write_seconds_total", time.perf_counter() - start, sink="parquet")
+            metrics.inc("tweets_written_total", len(batch), sink="parquet")
+            n_written += len(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is None:
+        logger.warning(f"No tweets to write to file")
+    else:
+        # readers of the directory never see a partly written file
+        os.replace(temp_file, part_file)
+
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.WARNING)
+    return(n_written)
+
+def parse_raw_page(content, columns=None):
+    # runs in a worker process: one response body -> (number of tweets, CSV rows as text).
+    # Workers share nothing, every page gets an include cache of its own.
+    page = json_loads(content)
+    if not "data" in page.keys():
+        return(0, "")
+
+    columns = column_selection(columns)
+    parsed_tweets = parse_tweets(page, EntityCache(), columns)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, dialect="unix")
+    for parsed_tweet in parsed_tweets:
+        writer.writerow(tweet_row(parsed_tweet, columns))
+    return(len(parsed_tweets), buffer.getvalue())
+
+def pages_to_csv(raw_pages, file_name, append=False, processes=None, verbose=False, columns=None):
+    # raw response bodies are parsed and serialized on a process pool, the CSV text of every page
+    # is written in the order of raw_pages
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.INFO)
+
+    columns = column_selection(columns)
+    # the workers get the column names, the selection is rebuilt there
+    parse_page = functools.partial(parse_raw_page, columns=None if columns is None else columns.columns)
+
+    file_mode = "a" if append else "w"
     if append:
         logger.info(f"Appending to file {file_name}")
     else:
         logger.info(f"Writing to file {file_name}")
         if os.path.isfile(file_name):
             logger.warning(f"Overwriting existing file ({file_name})")
-    
-    if queried_users:
-        with open(file_name, file_mode, newline='') as f:
+
+    f = None
+    n_written = 0
+    try:
+        for _, (n_tweets, rows) in ordered_map(parse_page, raw_pages, max_workers=processes or os.cpu_count(), executor_class=ProcessPoolExecutor):
+            if n_tweets == 0:
+                continue
+            if f is None:
+                write_header = new_csv_file(file_name, append)
+                if append:
+                    check_csv_header(file_name, tweet_header(columns))
+                f = open_csv(file_name, file_mode)
+                if write_header:
+                    csv.writer(f, dialect="unix").writerow(tweet_header(columns))
+            start = time.perf_counter()
+            f.write(rows)
+            metrics.inc("write_seconds_total", time.perf_counter() - start, sink="csv")
+            metrics.inc("tweets_written_total", n_tweets, sink="csv")
+            n_written += n_tweets
+    finally:
+        if f is not None:
+            f.close()
+
+    if n_written == 0:
+        logger.warning(f"No tweets to write to file")
+
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.WARNING)
+    return(n_written)
+
+def search_to_csv(query, bearer_token, file_name, since_id=None, until_id=None, start_time=None, end_time=None, mode="recent", append=False, processes=None, verbose=False, archive=None, columns=None):
+    # fetches in this process while a process pool parses and serializes the pages
+    columns = column_selection(columns)
+    raw_pages = iter_search_pages(query, bearer_token, since_id=since_id, until_id=until_id, start_time=start_time, end_time=end_time, mode=mode, verbose=verbose, raw=True, archive=archive, columns=columns)
+    return(pages_to_csv(raw_pages, file_name, append=append, processes=processes, verbose=verbose, columns=columns))
+
+def file_compression(file_name):
+    # "gz", "zst" or "" by extension
+    if file_name.endswith(".gz"):
+        return("gz")
+    if file_name.endswith(".zst"):
+        return("zst")
+    return("")
+
+def open_archive(file_name, mode="rb", compression=None):
+    # compression by extension (or as given): .gz (gzip), .zst (zstandard, if installed) or none
+    if compression is None:
+        compression = file_compression(file_name)
+    if compression == "gz":
+        return(gzip.open(file_name, mode))
+    if compression == "zst":
+        if zstandard is None:
+            raise Exception("zstandard is not installed, halting")
+        if "r" in mode:
+            return(zstandard.ZstdDecompressor().stream_reader(open(file_name, "rb"), read_across_frames=True, closefd=True))
+        return(zstandard.ZstdCompressor().stream_writer(open(file_name, mode), closefd=True))
+    return(open(file_name, mode))
+
+def open_csv(file_name, mode="r", compression=None):
+    # text file for the csv module, compressed like open_archive. Every append to a compressed file
+    # adds a gzip member / zstd frame, readers see one stream.
+    if compression is None:
+        compression = file_compression(file_name)
+    if compression == "gz":
+        # level 6 (zlib's default) instead of gzip's 9, which costs far more time for little space
+        return(gzip.open(file_name, f"{mode}t", compresslevel=6, encoding="utf-8", newline=''))
+    if compression == "zst":
+        f = open_archive(file_name, f"{mode}b", compression)
+        return(io.TextIOWrapper(io.BufferedReader(f) if mode == "r" else f, encoding="utf-8", newline=''))
+    return(open(file_name, mode, newline=''))
+
+def convert_csv(source_file, file_name):
+    # copies a CSV into file_name with the compression of its extension (write and rename), the
+    # source and its index are removed and file_name keeps the source's modification time
+    mtime = os.path.getmtime(source_file)
+    with open_csv(source_file) as source, open_csv(f"{file_name}.tmp", "w", file_compression(file_name)) as f:
+        shutil.copyfileobj(source, f, 2**20)
+    os.replace(f"{file_name}.tmp", file_name)
+    os.utime(file_name, (mtime, mtime))
+    os.remove(source_file)
+    if os.path.isfile(f"{source_file}.index.json"):
+        os.remove(f"{source_file}.index.json")
+
+def new_csv_file(file_name, append):
+    # the header is written unless rows are appended to a file that has some
+    return(not append or not os.path.isfile(file_name) or os.path.getsize(file_name) == 0)
+
+def archive_page(content, file_name):
+    # one raw response body per line (JSONL), appended so windows and resumed runs add to the same file.
+    # Raw newlines in JSON can only be whitespace between tokens, so they are replaced by spaces.
+    os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+    with open_archive(file_name, "ab") as f:
+        f.write(content.replace(b"\n", b" ").replace(b"\r", b" ") + b"\n")
+
+def archive_files(path):
+    # a single archive file or every archive file in a directory, in name order
+    if os.path.isdir(path):
+        return([os.path.join(path, n) for n in sorted(os.listdir(path)) if n.endswith((".jsonl", ".jsonl.gz", ".jsonl.zst"))])
+    return([path])
+
+def iter_archive_pages(path):
+    # raw response bodies from an archive file or directory, no network involved
+    for file_name in archive_files(path):
+        with open_archive(file_name, "rb") as f:
+            for line in io.BufferedReader(f) if file_name.endswith(".zst") else f:
+                if line.strip():
+                    yield(line.rstrip(b"\n"))
+
+def iter_archived_tweets(path, cache=None, columns=None):
+    # re-parses archived pages with the current parse_tweets and key_names
+    if cache is None:
+        cache = EntityCache()
+    columns = column_selection(columns)
+    for content in iter_archive_pages(path):
+        page = json_loads(content)
+        if "data" in page.keys():
+            for parsed_tweet in parse_tweets(page, cache, columns):
+                yield(parsed_tweet)
+
+def archive_to_csv(path, file_name, append=False, processes=None, verbose=False, columns=None):
+    # re-derives a tweets CSV from an archive on a process pool
+    return(pages_to_csv(iter_archive_pages(path), file_name, append=append, processes=processes, verbose=verbose, columns=columns))
+
+def csv_tweet_stats(file_name):
+    # number of tweets and newest status_id in a tweets_to_csv file, read row by row (or from the
+    # index of a merge_tweets_csv file)
+    n_tweets = 0
+    newest_status_id = None
+    if not os.path.isfile(file_name):
+        return(n_tweets, newest_status_id)
+    index = load_csv_index(file_name)
+    if index is not None:
+        return(index["n_rows"], index["last"][1] if index["last"] else None)
+
+    with open_csv(file_name) as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return(n_tweets, newest_status_id)
+        status_id_index = header.index("status_id")
+        for row in reader:
+            n_tweets += 1
+            try:
+                if newest_status_id is None or int(row[status_id_index]) > int(newest_status_id):
+                    newest_status_id = row[status_id_index]
+            except (IndexError, ValueError):
+                pass
+
+    return(n_tweets, newest_status_id)
+
+class UnsortedFile(Exception):
+    pass
+
+def tweet_sort_key(row):
+    # rows of key_names values: chronological, tweets of the same second by id
+    return((row[1], int(row[0])))
+
+def iter_csv_rows(file_name, header=True):
+    with open_csv(file_name) as f:
+        reader = csv.reader(f, dialect="unix")
+        if header:
+            next(reader, None)
+        for row in reader:
+            yield(row)
+
+def checked_order(rows):
+    # rows of a file that should be sorted already, UnsortedFile at the first row that isn't
+    last_key = None
+    for row in rows:
+        key = tweet_sort_key(row)
+        if last_key is not None and key < last_key:
+            raise UnsortedFile()
+        last_key = key
+        yield(row)
+
+def sorted_runs(rows, path, chunk_size=100000):
+    # rows in sorted files of at most chunk_size rows, returns their names
+    os.makedirs(path, exist_ok=True)
+    run_files = []
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        chunk.sort(key=tweet_sort_key)
+        run_file = f"{path}/run-{len(run_files):05d}.csv"
+        with open(run_file, "w", newline='') as f:
+            csv.writer(f, dialect="unix").writerows(chunk)
+        run_files.append(run_file)
+    return(run_files)
+
+def unique_rows(rows, header=key_names):
+    # sorted rows without repeated status_ids, of every tweet the most recently queried row is kept
+    queried_at = header.index("queried_at")
+    previous = None
+    for row in rows:
+        if previous is not None and previous[0] == row[0]:
+            if int(row[queried_at] or 0) >= int(previous[queried_at] or 0):
+                previous = row
+            continue
+        if previous is not None:
+            yield(previous)
+        previous = row
+    if previous is not None:
+        yield(previous)
+
+def check_csv_header(file_name, header):
+    # rows are only added to a file of the same columns, a different selection would mix row widths
+    if not os.path.isfile(file_name) or os.path.getsize(file_name) == 0:
+        return
+    with open_csv(file_name) as f:
+        file_header = next(csv.reader(f), None)
+    if file_header is not None and file_header != header:
+        raise Exception(f"Columns of {file_name} differ from the selected columns, halting")
+
+def load_csv_index(file_name):
+    # the index of a merge_tweets_csv file, None if there is none or the file was changed since
+    try:
+        with open(f"{file_name}.index.json", "r") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return(None)
+    if not os.path.isfile(file_name) or os.path.getsize(file_name) != index["file_size"]:
+        return(None)
+    return(index)
+
+def write_csv_rows(rows, f, index, index_every=1000):
+    # writes rows to f and adds every index_every-th row's created_at and offset to index (no
+    # offsets with index_every=None, a compressed file can't seek to them)
+    writer = csv.writer(f, dialect="unix")
+    for row in rows:
+        if index_every and index["n_rows"] % index_every == 0:
+            f.flush()
+            index["offsets"].append([row[1], f.tell()])
+        writer.writerow(row)
+        index["n_rows"] += 1
+        index["last"] = [row[1], row[0]]
+
+def save_csv_index(file_name, index):
+    index["file_size"] = os.path.getsize(file_name)
+    with open(f"{file_name}.index.json.tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(f"{file_name}.index.json.tmp", f"{file_name}.index.json")
+
+def merge_tweets_csv(queried_tweets, file_name, chunk_size=100000, verbose=False, columns=None):
+    # merges queried_tweets into file_name, which stays sorted by created_at / status_id with one row
+    # per tweet (the most recently queried). New tweets are sorted in runs of chunk_size on disk and
+    # merged with the file, nothing is held in memory but one chunk. Tweets newer than the whole
+    # file are appended. An unsorted file (tweets_to_csv, backfill_windows) is sorted on the first
+    # merge. {file_name}.index.json holds the offset of every 1000th row for iter_csv_range.
+    # Returns the number of tweets in the file.
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.INFO)
+
+    columns = column_selection(columns)
+    header = tweet_header(columns)
+    compression = file_compression(file_name)
+    index_every = None if compression else 1000
+
+    runs_path = f"{file_name}.runs"
+    shutil.rmtree(runs_path, ignore_errors=True)
+    try:
+        run_files = sorted_runs((tweet_row(t, columns) for t in (queried_tweets or [])), runs_path, chunk_size)
+        new_rows = lambda: unique_rows(heapq.merge(*(iter_csv_rows(run_file, header=False) for run_file in run_files), key=tweet_sort_key), header)
+        first_new = min((next(iter_csv_rows(run_file, header=False)) for run_file in run_files), key=tweet_sort_key, default=None)
+
+        # appended or merged, the rows must have the file's columns
+        check_csv_header(file_name, header)
+        index = load_csv_index(file_name)
+        if index is not None and first_new is None:
+            # sorted already and nothing to add
+            pass
+        elif index is not None and (index["last"] is None or tweet_sort_key([index["last"][1], index["last"][0]]) < tweet_sort_key(first_new)):
+            # everything is newer than the file
+            logger.info(f"Appending to file {file_name}")
+            with open_csv(file_name, "a") as f:
+                write_csv_rows(new_rows(), f, index, index_every)
+            save_csv_index(file_name, index)
+        else:
+            logger.info(f"Merging into file {file_name}")
+
+            def merge(existing_rows):
+                index = {"n_rows": 0, "last": None, "offsets": []}
+                with open_csv(f"{file_name}.tmp", "w", compression) as f:
+                    csv.writer(f, dialect="unix").writerow(header)
+                    write_csv_rows(unique_rows(heapq.merge(existing_rows, new_rows(), key=tweet_sort_key), header), f, index, index_every)
+                return(index)
+
+            existing = os.path.isfile(file_name)
+            try:
+                index = merge(checked_order(iter_csv_rows(file_name)) if existing else iter([]))
+            except UnsortedFile:
+                logger.info(f"Sorting {file_name}")
+                existing_runs = sorted_runs(iter_csv_rows(file_name), f"{runs_path}/existing", chunk_size)
+                index = merge(heapq.merge(*(iter_csv_rows(run_file, header=False) for run_file in existing_runs), key=tweet_sort_key))
+            os.replace(f"{file_name}.tmp", file_name)
+            save_csv_index(file_name, index)
+    finally:
+        shutil.rmtree(runs_path, ignore_errors=True)
+
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.WARNING)
+    return(index["n_rows"] if index is not None else 0)
+
+def iter_csv_range(file_name, start_time=None, end_time=None):
+    # rows of a merge_tweets_csv file with start_time <= created_at < end_time (ISO 8601 strings
+    # as in the file), starting at the indexed offset before start_time instead of the top
+    index = load_csv_index(file_name)
+    with open_csv(file_name) as f:
+        if index is not None and start_time and index["offsets"]:
+            position = bisect.bisect_left([created_at for created_at, _ in index["offsets"]], start_time)
+            f.seek(index["offsets"][max(position - 1, 0)][1])
+        else:
+            f.readline()
+        for row in csv.reader(f, dialect="unix"):
+            if row[:1] == ["status_id"]:
+                continue
+            if end_time and row[1] >= end_time:
+                if index is not None:
+                    break
+                continue
+            if start_time and row[1] < start_time:
+                continue
+            yield(row)
+
+def users_to_csv(queried_users, file_name, append=False, verbose=False, columns=None):
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.INFO)
+
+    columns = columns or user_key_names
+    file_mode = "a" if append else "w"
+    if append:
+        logger.info(f"Appending to file {file_name}")
+    else:
+        logger.info(f"Writing to file {file_name}")
+        if os.path.isfile(file_name):
+            logger.warning(f"Overwriting existing file ({file_name})")
+
+    # queried_users may be a list or a generator (retweet_users_bulk), rows are written as they arrive
+    queried_users = iter(queried_users or [])
+    first_user = next(queried_users, None)
+    n_written = 0
+    if first_user is not None:
+        write_header = new_csv_file(file_name, append)
+        with open_csv(file_name, file_mode) as f:
             writer = csv.writer(f, dialect="unix")
-            if not append:
-                writer.writerow([
-                    "user_id",
-                    "screen_name",
-                    "name",
-                    "created_at",
-                    "description",
-                    "url",
-                    "location",
-                    "followers_count",
-                    "following_count",
-                    "tweet_count",
-                    "listed_count",
-                    "protected",
-                    "verified",
-                    "withheld",
-                    "pinned_tweet_id",
-                    "queried_at"
-                    ])
-            elif append and os.path.getsize(file_name) == 0:
-                writer.writerow([
-                    "user_id",
-                    "screen_name",
-                    "name",
-                    "created_at",
-                    "description",
-                    "url",
-                    "location",
-                    "followers_count",
-                    "following_count",
-                    "tweet_count",
-                    "listed_count",
-                    "protected",
-                    "verified",
-                    "withheld",
-                    "pinned_tweet_id",
-                    "queried_at"
-                    ])
-            
-            for parsed_user in queried_users:
-                writer.writerow([
-                    parsed_user["user_id"],
-                    parsed_user["screen_name"],
-                    parsed_user["name"],
-                    parsed_user["created_at"],
-                    parsed_user["description"],
-                    parsed_user["url"],
-                    parsed_user["location"],
-                    parsed_user["followers_count"],
-                    parsed_user["following_count"],
-                    parsed_user["tweet_count"],
-                    parsed_user["listed_count"],
-                    parsed_user["protected"],
-                    parsed_user["verified"],
-                    parsed_user["withheld"],
-                    parsed_user["pinned_tweet_id"],
-                    parsed_user["queried_at"]
-                    ])
+            if write_header:
+                writer.writerow(columns)
+            for parsed_user in itertools.chain([first_user], queried_users):
+                writer.writerow([parsed_user[k] for k in columns])
+                n_written += 1
     else:
-        logger.warning(f"No tweets to write to file")
+        logger.warning(f"No users to write to file")
+
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.WARNING)
+    return(n_written)
+
+def to_sqlite_value(value, column_type):
+    # ids and counts as integers, booleans as 0/1, timestamps as ISO text so they sort
+    if value == "" or value is None:
+        return(None)
+    if column_type == "int":
+        return(int(value))
+    if column_type == "bool":
+        if isinstance(value, bool):
+            return(int(value))
+        return(int(value == "True"))
+    if column_type == "timestamp" and str(value).isdigit():
+        return(f"{datetime.datetime.fromtimestamp(int(value), tz=datetime.timezone.utc):%Y-%m-%dT%H:%M:%S.000Z}")
+    if isinstance(value, (list, dict)):
+        return(json.dumps(value))
+    return(value)
+
+def open_store(file_name):
+    connection = sqlite3.connect(file_name)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+
+    column_types = tweet_column_types()
+    tweet_columns = ", ".join(f"{key} {'INTEGER' if column_types[key] in ('int', 'bool') else 'TEXT'}" for key in key_names if key != "status_id")
+    connection.execute(f"CREATE TABLE IF NOT EXISTS tweets (status_id INTEGER PRIMARY KEY, {tweet_columns})")
+    connection.execute("CREATE INDEX IF NOT EXISTS tweets_created_at ON tweets (created_at)")
+    connection.execute("CREATE INDEX IF NOT EXISTS tweets_screen_name ON tweets (screen_name COLLATE NOCASE, created_at)")
+
+    user_columns = ", ".join(f"{key} {'INTEGER' if key.endswith('_count') or key in ('protected', 'verified', 'pinned_tweet_id') else 'TEXT'}" for key in user_key_names if key != "user_id")
+    connection.execute(f"CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, {user_columns})")
+    connection.execute("CREATE INDEX IF NOT EXISTS users_screen_name ON users (screen_name COLLATE NOCASE)")
+    connection.commit()
+    return(connection)
+
+def upsert_rows(connection, table, key, columns, rows, batch_size=5000):
+    # rows already stored are updated in place, a re-fetch refreshes the metrics instead of adding a copy
+    updates = ", ".join(f"{column}=excluded.{column}" for column in columns if column != key)
+    statement = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)}) ON CONFLICT({key}) DO UPDATE SET {updates}"
+    n_written = 0
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        start = time.perf_counter()
+        with connection:
+            connection.executemany(statement, batch)
+        metrics.inc("write_seconds_total", time.perf_counter() - start, sink="sqlite")
+        metrics.inc(f"{table}_written_total", len(batch), sink="sqlite")
+        n_written += len(batch)
+    return(n_written)
+
+def tweets_to_sqlite(queried_tweets, file_name, batch_size=5000, verbose=False, columns=None):
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.INFO)
+
+    logger.info(f"Writing to store {file_name}")
+    # only the selected columns are inserted or updated, stored values of the others are kept
+    columns = column_selection(columns)
+    header = tweet_header(columns)
+    column_types = tweet_column_types()
+    connection = open_store(file_name)
+    try:
+        rows = ([to_sqlite_value(value, column_types[k]) for k, value in zip(header, tweet_row(parsed_tweet, columns))] for parsed_tweet in (queried_tweets or []))
+        n_written = upsert_rows(connection, "tweets", "status_id", header, rows, batch_size=batch_size)
+    finally:
+        connection.close()
+
+    if n_written == 0:
+        logger.warning(f"No tweets to write to store")
+
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.WARNING)
+    return(n_written)
+
+def users_to_sqlite(queried_users, file_name, batch_size=5000, verbose=False):
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.INFO)
+
+    logger.info(f"Writing to store {file_name}")
+    column_types = {key: "int" if key.endswith("_count") or key == "pinned_tweet_id" else "bool" if key in ("protected", "verified") else "timestamp" if key == "queried_at" else "string" for key in user_key_names}
+    connection = open_store(file_name)
+    try:
+        rows = ([to_sqlite_value(parsed_user[k], column_types[k]) for k in user_key_names] for parsed_user in (queried_users or []))
+        n_written = upsert_rows(connection, "users", "user_id", user_key_names, rows, batch_size=batch_size)
+    finally:
+        connection.close()
+
+    if n_written == 0:
+        logger.warning(f"No users to write to store")
 
     if verbose and logger.level >= 20:
         logger.setLevel(logging.WARNING)
+    return(n_written)
+
+def csv_to_sqlite(csv_file, file_name, batch_size=5000, verbose=False):
+    # import an existing tweets_to_csv file, rows come back as strings and are converted like parsed tweets.
+    # A file of selected columns only sets those.
+    with open_csv(csv_file) as f:
+        reader = csv.DictReader(f)
+        return(tweets_to_sqlite(reader, file_name, batch_size=batch_size, verbose=verbose, columns=reader.fieldnames))
+
+def store_where(screen_name=None, start_time=None, end_time=None):
+    conditions = []
+    values = []
+    if screen_name:
+        conditions.append("screen_name = ? COLLATE NOCASE")
+        values.append(screen_name)
+    if start_time:
+        conditions.append("created_at >= ?")
+        values.append(start_time)
+    if end_time:
+        conditions.append("created_at < ?")
+        values.append(end_time)
+    return((f" WHERE {' AND '.join(conditions)}" if conditions else ""), values)
+
+def count_tweets(file_name, screen_name=None, start_time=None, end_time=None):
+    where, values = store_where(screen_name, start_time, end_time)
+    connection = open_store(file_name)
+    try:
+        return(connection.execute(f"SELECT COUNT(*) FROM tweets{where}", values).fetchone()[0])
+    finally:
+        connection.close()
+
+def tweet_date_range(file_name, screen_name=None):
+    where, values = store_where(screen_name)
+    connection = open_store(file_name)
+    try:
+        return(connection.execute(f"SELECT MIN(created_at), MAX(created_at) FROM tweets{where}", values).fetchone())
+    finally:
+        connection.close()
+
+def iter_stored_tweets(file_name, screen_name=None, start_time=None, end_time=None):
+    # stored tweets as dicts keyed like parsed tweets, oldest first
+    where, values = store_where(screen_name, start_time, end_time)
+    connection = open_store(file_name)
+    try:
+        for row in connection.execute(f"SELECT {', '.join(key_names)} FROM tweets{where} ORDER BY created_at", values):
+            yield(dict(zip(key_names, row)))
+    finally:
+        connection.close()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Statistics of Data/<user>.csv (.csv.gz, .csv.zst, or a Data/<user>.parquet directory from
+# tweets_to_parquet), written to Output/<user>_*. Needs numpy and pandas (pip install numpy pandas),
+# and matplotlib for the _tweets.png and _time_of_day.png infographics. get_user.py and get_users.py
+# call user_stats() after every account, this script reruns it on the stored data.
+#
+#   python src/user_stats.py <user_name> [timezone]
+#   python src/user_stats.py --batch users.txt [timezone]
+
+import sys
+import os
+import json
+
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:
+    np = None
+    pd = None
+
+try:
+    import matplotlib.dates
+    import matplotlib.ticker
+    # no pyplot, figures are drawn without a GUI backend and can be made on any thread
+    from matplotlib.figure import Figure
+except ImportError:
+    Figure = None
+
+weekdays = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+stats_columns = ["status_id", "created_at", "screen_name", "hashtags", "mentions", "is_retweet", "is_reply", "is_quote", "retweet_count", "reply_count", "like_count", "quote_count"]
+engagement_columns = ["retweet_count", "reply_count", "like_count", "quote_count"]
+quantiles = [0, 0.25, 0.5, 0.75, 0.9, 0.99, 1]
+# tweets, retweets
+colors = ["#008837", "#7b3294"]
+
+def tweets_file(user_name, data_path="Data"):
+    # the most recently written of the Parquet directory and the plain or compressed CSV of the
+    # user, None if there is none. get_user.py writes Data/<user_name in lower case>.csv[.gz|.zst],
+    # the case of user_name doesn't matter.
+    names = {name.lower(): name for name in os.listdir(data_path)} if os.path.isdir(data_path) else {}
+    found = [f"{data_path}/{names[file_name]}" for file_name in [f"{user_name.lower()}.parquet", f"{user_name.lower()}.csv", f"{user_name.lower()}.csv.gz", f"{user_name.lower()}.csv.zst"] if file_name in names]
+    return(max(found, key=os.path.getmtime, default=None))
+
+def read_tweets(user_name, data_path="Data"):
+    # the columns needed for the statistics, one row per status_id of the user's own timeline
+    file_name = tweets_file(user_name, data_path)
+    if os.path.isdir(file_name):
+        df = pd.read_parquet(file_name, columns=stats_columns)
+    else:
+        # compression by extension
+        df = pd.read_csv(file_name, usecols=stats_columns, dtype={"status_id": str, "screen_name": str, "hashtags": str, "mentions": str, "is_retweet": str, "is_reply": str, "is_quote": str}, keep_default_na=False)
+        # JSON lists in the CSV, list columns in Parquet
+        for column in ["hashtags", "mentions"]:
+            df[column] = df[column].str.findall(r'"([^"]*)"')
+
+    df = df[df["screen_name"].str.lower() == user_name.lower()]
+    df = df.drop_duplicates("status_id")
+    df["created_at"] = pd.to_datetime(df["created_at"], utc=True)
+    for column in ["is_retweet", "is_reply", "is_quote"]:
+        if df[column].dtype != bool:
+            df[column] = df[column] == "True"
+    for column in engagement_columns:
+        df[column] = pd.to_numeric(df[column], errors="coerce").fillna(0).astype(np.int64)
+    return(df.reset_index(drop=True))
+
+def activity(df, tz="UTC"):
+    # weekday x hour matrix of tweet counts in the timezone tz
+    created_at = df["created_at"].dt.tz_convert(tz)
+    cells = created_at.dt.weekday.to_numpy() * 24 + created_at.dt.hour.to_numpy()
+    counts = np.bincount(cells, minlength=7*24).reshape(7, 24)
+    return(pd.DataFrame(counts, index=pd.Index(weekdays, name="weekday"), columns=range(24)))
+
+def top_entities(values, n=50):
+    # most frequent entries of a list column (hashtags, mentions), case-insensitive
+    entities = values.explode().dropna().str.lower()
+    return(entities.value_counts().head(n).rename_axis("entity").reset_index(name="n"))
+
+def engagement(df):
+    # distribution of the public metrics of the user's own tweets (a retweet counts the original's)
+    own = df.loc[~df["is_retweet"], engagement_columns]
+    if len(own) == 0:
+        return(pd.DataFrame(index=engagement_columns))
+    distribution = own.quantile(quantiles).T
+    distribution.columns = [f"q{int(q*100)}" for q in quantiles]
+    distribution.insert(0, "mean", own.mean())
+    distribution.insert(0, "n", len(own))
+    return(distribution.rename_axis("metric"))
+
+def summary(df, user_name, tz="UTC"):
+    n_total = len(df)
+    stats = {"user_name": user_name, "timezone": tz, "n_total": n_total}
+    if n_total == 0:
+        return(stats)
+
+    first, last = df["created_at"].min(), df["created_at"].max()
+    days = max((last - first).total_seconds() / 86400, 1)
+    recent = df["created_at"] > last - pd.Timedelta(days=100)
+    stats.update({
+        "n_tweets": int((~df["is_retweet"]).sum()),
+        "n_retweets": int(df["is_retweet"].sum()),
+        "p_retweets": float(df["is_retweet"].mean()),
+        "p_replies": float(df["is_reply"].mean()),
+        "p_quotes": float(df["is_quote"].mean()),
+        "first_tweet": first.isoformat(),
+        "last_tweet": last.isoformat(),
+        "tweets_per_day": n_total / days,
+        "tweets_per_day_no_rt": int((~df["is_retweet"]).sum()) / days,
+        "tweets_per_day_100": int(recent.sum()) / 100 if days > 100 else None,
+        "tweets_per_day_100_no_rt": int((recent & ~df["is_retweet"]).sum()) / 100 if days > 100 else None
+    })
+    return(stats)
+
+def plot_tweets(df, stats, file_name, tz="UTC"):
+    # every tweet by date and time of day (jittered), with the tweets per date above and per hour
+    # on the right, as gen_stats.R drew it
+    created_at = df["created_at"].dt.tz_convert(tz)
+    dates = matplotlib.dates.date2num(created_at.dt.tz_localize(None).dt.normalize().to_numpy())
+    hours = created_at.dt.hour.to_numpy() + created_at.dt.minute.to_numpy() / 60
+    retweet = df["is_retweet"].to_numpy()
+    rng = np.random.default_rng(0)
+
+    fig = Figure(figsize=(15, 10))
+    grid = fig.add_gridspec(2, 2, height_ratios=[2, 10], width_ratios=[10, 2], hspace=0.02, wspace=0.02)
+    ax_dates = fig.add_subplot(grid[0, 0])
+    ax = fig.add_subplot(grid[1, 0], sharex=ax_dates)
+    ax_hours = fig.add_subplot(grid[1, 1], sharey=ax)
+
+    ax_dates.hist([dates[~retweet], dates[retweet]], bins=max(len(np.unique(dates)) // 10, 1), stacked=True, color=colors)
+    ax_dates.axis("off")
+    for n, (label, selected) in enumerate([("Tweet", ~retweet), ("Retweet", retweet)]):
+        ax.scatter(dates[selected] + rng.uniform(-0.4, 0.4, selected.sum()), hours[selected] + rng.uniform(-0.2, 0.2, selected.sum()), s=6, alpha=0.25, color=colors[n], label=label)
+    ax.xaxis_date()
+    ax.set_yticks(range(24))
+    ax.set_ylim(-0.5, 24)
+    ax.set_xlabel("Date")
+    ax.set_ylabel(f"Hour ({tz})")
+    ax.legend(title="Type", loc="upper center", bbox_to_anchor=(0.5, -0.08), ncol=2, markerscale=3)
+    ax_hours.barh(np.arange(24) + 0.5, np.bincount(created_at.dt.hour.to_numpy(), minlength=24), height=0.9, color="grey")
+    ax_hours.axis("off")
+
+    fig.suptitle(f"@{stats['user_name']}\nUser has {stats['n_total']:,} tweets ({100*stats['p_retweets']:.2f}% retweets)", x=0.125, ha="left")
+    fig.savefig(file_name, dpi=300, bbox_inches="tight")
+
+def plot_time_of_day(df, stats, file_name, tz="UTC"):
+    # shares of tweets by weekday, hour, minute and second
+    created_at = df["created_at"].dt.tz_convert(tz)
+    fig = Figure(figsize=(15, 10))
+    grid = fig.add_gridspec(2, 2, height_ratios=[6, 3])
+    for n, (label, values, ticks) in enumerate([
+        ("Weekday", np.bincount(created_at.dt.weekday.to_numpy(), minlength=7), weekdays),
+        (f"Hours ({tz})", np.bincount(created_at.dt.hour.to_numpy(), minlength=24), range(24)),
+        ("Minutes", np.bincount(created_at.dt.minute.to_numpy(), minlength=60), None),
+        ("Seconds", np.bincount(created_at.dt.second.to_numpy(), minlength=60), None)
+    ]):
+        ax = fig.add_subplot(grid[n // 2, n % 2])
+        ax.bar(range(len(values)), values / values.sum(), color="grey")
+        if ticks is not None:
+            ax.set_xticks(range(len(values)), ticks)
+        else:
+            ax.set_xticks(range(0, 61, 15))
+        ax.yaxis.set_major_formatter(matplotlib.ticker.PercentFormatter(1))
+        ax.set_xlabel(label)
+
+    first, last = stats["first_tweet"][:10], stats["last_tweet"][:10]
+    per_day = f"@{stats['user_name']} posted on average {stats['tweets_per_day']:.2f} tweets per day ({stats['tweets_per_day_no_rt']:.2f} without retweets) from {first} to {last}."
+    if stats["tweets_per_day_100"] is not None:
+        per_day += f"\nOver the last 100 days @{stats['user_name']} posted {stats['tweets_per_day_100']:.2f} tweets per day ({stats['tweets_per_day_100_no_rt']:.2f} without retweets)."
+    fig.suptitle(per_day, x=0.125, ha="left")
+    fig.savefig(file_name, dpi=300, bbox_inches="tight")
+
+def user_stats(user_name, tz="UTC", data_path="Data", output_path="Output"):
+    # writes Output/<user>_stats.json, _activity.csv (weekday x hour), _hashtags.csv, _mentions.csv
+    # and _engagement.csv, and with matplotlib _tweets.png and _time_of_day.png. Returns the summary.
+    df = read_tweets(user_name, data_path)
+    os.makedirs(output_path, exist_ok=True)
+    prefix = f"{output_path}/{user_name.lower()}"
+
+    stats = summary(df, user_name, tz)
+    with open(f"{prefix}_stats.json", "w") as f:
+        json.dump(stats, f, indent=2)
+    activity(df, tz).to_csv(f"{prefix}_activity.csv")
+    top_entities(df["hashtags"]).to_csv(f"{prefix}_hashtags.csv", index=False)
+    top_entities(df["mentions"]).to_csv(f"{prefix}_mentions.csv", index=False)
+    engagement(df).to_csv(f"{prefix}_engagement.csv")
+    if Figure is not None and stats["n_total"] > 0:
+        plot_tweets(df, stats, f"{prefix}_tweets.png", tz)
+        plot_time_of_day(df, stats, f"{prefix}_time_of_day.png", tz)
+    return(stats)
+
+def stats_line(user_name, stats):
+    if stats["n_total"] == 0:
+        return(f"\t@{user_name}: no tweets")
+    return(f"\t@{user_name}: {stats['n_total']} tweets, {100*stats['p_retweets']:.2f}% retweets, {100*stats['p_replies']:.2f}% replies, {stats['tweets_per_day']:.2f} per day")
+
+if __name__ == "__main__":
+    if pd is None:
+        print("user_stats.py needs numpy and pandas (pip install numpy pandas)")
+        exit(1)
+
+    if sys.argv[1] == "--batch":
+        with open(sys.argv[2], "r") as f:
+            user_names = [l.strip().lstrip("@") for l in f if l.strip() and not l.startswith("#")]
+        tz = sys.argv[3] if len(sys.argv) > 3 else "UTC"
+    else:
+        user_names = [sys.argv[1]]
+        tz = sys.argv[2] if len(sys.argv) > 2 else "UTC"
+
+    for user_name in dict.fromkeys(user_names):
+        if tweets_file(user_name) is None:
+            print(f"\t@{user_name}: no data")
+            continue
+        print(stats_line(user_name, user_stats(user_name, tz)))
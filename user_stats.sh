@@ -3,6 +3,14 @@
 mkdir -p Data
 mkdir -p Output
 
+if [ "$1" == "--batch" ]
+  then
+    # bash user_stats.sh --batch users.txt Europe/Berlin
+    source venv/bin/activate
+    python src/get_users.py "$2" $3
+    exit
+fi
+
 if [ $# -eq 0 ]
   then
     read -p "Enter your username: @" TWITTER_USERNAME
@@ -28,6 +36,4 @@ fi
 echo "Getting stats for user $TWITTER_USERNAME (TZ $USER_TZ)"
 
 source venv/bin/activate
-python src/get_user.py $TWITTER_USERNAME
-echo "Generating info graphics"
-Rscript src/gen_stats.R $TWITTER_USERNAME $USER_TZ
+python src/get_user.py $TWITTER_USERNAME $USER_TZ